@@ -0,0 +1,100 @@
+"""
+new-comment announcements to c3po, sent from a queue so a slow or dead
+c3po doesn't hold up the request that made the comment
+"""
+import logging, time, urllib
+from twisted.internet import reactor
+from twisted.web.client import getPage
+import metrics
+log = logging.getLogger()
+
+LISTENERS = [
+    ('http://bigasterisk.com/foaf.rdf#drewp', 'xmpp'),
+    ('http://bigasterisk.com/kelsi/foaf.rdf#kelsi', 'xmpp'),
+    ]
+
+class AlertQueue(object):
+    def __init__(self, url='http://bang:9040/', listeners=LISTENERS,
+                 coalesceSecs=5, retries=5, backoffSecs=2, timeout=10,
+                 clock=reactor):
+        """
+        messages that arrive within coalesceSecs of each other go out
+        as one post per listener. Failed posts are retried after
+        backoffSecs, doubling each time, up to retries times.
+        """
+        self.url = url
+        self.listeners = listeners
+        self.coalesceSecs = coalesceSecs
+        self.retries = retries
+        self.backoffSecs = backoffSecs
+        self.timeout = timeout
+        self.clock = clock
+
+        self.pending = [] # (enqueueTime, msg)
+        self.flushCall = None
+        self.inFlight = 0 # messages posted or waiting to retry
+        self.delivered = 0
+        self.failed = 0
+        self.lastLatency = None # secs from enqueue to delivery
+
+    def add(self, msg):
+        self.pending.append((time.time(), msg))
+        if self.flushCall is None:
+            self.flushCall = self.clock.callLater(self.coalesceSecs,
+                                                  self.flush)
+
+    def depth(self):
+        return len(self.pending) + self.inFlight
+
+    def stats(self):
+        return dict(depth=self.depth(), delivered=self.delivered,
+                    failed=self.failed, lastLatency=self.lastLatency)
+
+    def flush(self):
+        self.flushCall = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        msg = combinedMessage([m for t, m in batch])
+        oldest = batch[0][0]
+        for listener, mode in self.listeners:
+            self.inFlight += len(batch)
+            self._send(dict(user=listener, msg=msg, mode=mode),
+                       len(batch), oldest, attempt=0)
+
+    def _send(self, payload, count, oldest, attempt):
+        d = getPage(self.url, method='POST',
+                    postdata=urllib.urlencode(payload),
+                    headers={'content-type' :
+                             'application/x-www-form-urlencoded'},
+                    timeout=self.timeout)
+        metrics.timedDeferred(d, 'stage_seconds', stage='sendAlerts')
+        d.addCallbacks(self._sent, self._sendFailed,
+                       callbackArgs=(count, oldest),
+                       errbackArgs=(payload, count, oldest, attempt))
+
+    def _sent(self, result, count, oldest):
+        self.inFlight -= count
+        self.delivered += count
+        self.lastLatency = time.time() - oldest
+
+    def _sendFailed(self, failure, payload, count, oldest, attempt):
+        if attempt >= self.retries:
+            log.error("giving up on alert to %s: %s" %
+                      (payload['user'], failure.getErrorMessage()))
+            self.inFlight -= count
+            self.failed += count
+            return
+        delay = self.backoffSecs * 2 ** attempt
+        log.warn("alert to %s failed (%s), retrying in %s sec" %
+                 (payload['user'], failure.getErrorMessage(), delay))
+        self.clock.callLater(delay, self._send, payload, count, oldest,
+                             attempt + 1)
+
+def combinedMessage(msgs, maxListed=5):
+    if len(msgs) == 1:
+        return msgs[0]
+    lines = msgs[:maxListed]
+    if len(msgs) > maxListed:
+        lines.append("and %s more" % (len(msgs) - maxListed))
+    return "%s new comments:\n%s" % (len(msgs), "\n".join(lines))
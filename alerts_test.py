@@ -0,0 +1,63 @@
+import unittest
+from nose.twistedtools import reactor, deferred
+from twisted.internet import defer
+from twisted.web import server, resource
+from alerts import AlertQueue, combinedMessage
+
+class StubC3po(resource.Resource):
+    """records posts; fails the first `failures` of them"""
+    isLeaf = True
+    def __init__(self, failures=0):
+        resource.Resource.__init__(self)
+        self.failures = failures
+        self.posts = []
+        self.arrived = defer.Deferred()
+
+    def render_POST(self, request):
+        if self.failures:
+            self.failures -= 1
+            request.setResponseCode(503)
+            return "down"
+        self.posts.append(dict((k, v[0]) for k, v in request.args.items()))
+        if not self.arrived.called:
+            self.arrived.callback(None)
+        return "ok"
+
+class TestAlertQueue(unittest.TestCase):
+    def startStub(self, stub):
+        port = reactor.listenTCP(0, server.Site(stub), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        return 'http://127.0.0.1:%d/' % port.getHost().port
+
+    @deferred(timeout=5)
+    def testBurstIsCoalescedPerListener(self):
+        stub = StubC3po()
+        q = AlertQueue(url=self.startStub(stub), coalesceSecs=.1,
+                       listeners=[('http://example.com/a', 'xmpp')])
+        for i in range(20):
+            q.add("comment %s" % i)
+        self.assertEqual(q.depth(), 20)
+        def check(_):
+            self.assertEqual(len(stub.posts), 1)
+            self.assertEqual(stub.posts[0]['user'], 'http://example.com/a')
+            self.assertTrue(stub.posts[0]['msg'].startswith('20 new comments'))
+        return stub.arrived.addCallback(check)
+
+    @deferred(timeout=5)
+    def testRetriesAfterFailure(self):
+        stub = StubC3po(failures=2)
+        q = AlertQueue(url=self.startStub(stub), coalesceSecs=0,
+                       backoffSecs=.05,
+                       listeners=[('http://example.com/a', 'xmpp')])
+        q.add("hello")
+        def check(_):
+            self.assertEqual([p['msg'] for p in stub.posts], ['hello'])
+        return stub.arrived.addCallback(check)
+
+class TestCombinedMessage(unittest.TestCase):
+    def testOne(self):
+        self.assertEqual(combinedMessage(["a"]), "a")
+
+    def testLongListIsTruncated(self):
+        msg = combinedMessage(["m%s" % i for i in range(8)], maxListed=2)
+        self.assertEqual(msg, "8 new comments:\nm0\nm1\nand 6 more")
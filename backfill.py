@@ -0,0 +1,29 @@
+# store sanitized html on comment docs that don't have it yet, or that
+# were sanitized by an older SANITIZER_VERSION, and the listing fields
+# (db.docFields) on docs from before those. Safe to rerun.
+from db import DbMongo, CONTENT, docFields, parseDoc
+from sanitize import sanitize_html, SANITIZER_VERSION
+db = DbMongo()
+coll = db.mongo['comment']
+
+done = 0
+for doc in coll.find({'sanitizerVersion' : {'$ne' : SANITIZER_VERSION}}):
+    for _, _, content in parseDoc(doc).triples((None, CONTENT.encoded, None)):
+        coll.update({'_id' : doc['_id']},
+                    {'$set' : {'html' : sanitize_html(content),
+                               'sanitizerVersion' : SANITIZER_VERSION}},
+                    safe=True)
+        done += 1
+        if done % 1000 == 0:
+            print done
+print "resanitized %s comments" % done
+
+done = 0
+for doc in coll.find({'uri' : {'$exists' : False}}):
+    fields = docFields(parseDoc(doc))
+    if fields:
+        coll.update({'_id' : doc['_id']}, {'$set' : fields}, safe=True)
+        done += 1
+        if done % 1000 == 0:
+            print done
+print "added listing fields to %s comments" % done
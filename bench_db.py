@@ -0,0 +1,165 @@
+#!/usr/bin/python
+"""
+read latency right after a write, for the incremental and the
+full-rebuild DbMongo modes.
+
+  bin/python bench_db.py [--host localhost] [--sizes 10000,100000,1000000]
+
+or, with --columnar, memory and lookup latency of DbMongo vs
+DbColumnar holding the same synthetic comments.
+
+or, with --startup, how long DbMongo takes to get ready by parsing
+everything vs. loading a snapshot and syncing what's newer.
+
+This fills a scratch database (comment_bench) on the given mongo
+server, so don't point it at the real 'comment' db.
+"""
+import os, time, tempfile, shutil, datetime, optparse
+from dateutil.tz import tzlocal
+from rdflib import URIRef, Literal, RDF
+from db import DbMongo, SIOC, DCTERMS, CONTENT
+from columnstore import DbColumnar
+
+def syntheticDoc(i, created):
+    comment = "http://bigasterisk.com/comment/bench%d" % i
+    parent = "http://example.com/post/%d" % (i % 1000)
+    return {
+        'ctx' : parent + "/comments",
+        'topic' : parent,
+        'created' : created,
+        'n3' : ('<%(parent)s> <%(sioc)shas_reply> <%(comment)s> .\n'
+                '<%(comment)s> <%(dcterms)screated> "%(created)s"^^<http://www.w3.org/2001/XMLSchema#dateTime> ;\n'
+                '  <%(sioc)shas_creator> <http://bigasterisk.com/guest/bench%(i)d> ;\n'
+                '  <%(content)sencoded> "comment number %(i)d"^^<http://www.w3.org/1999/02/22-rdf-syntax-ns#XMLLiteral> .\n' % dict(
+                    parent=parent, comment=comment, i=i, created=created.isoformat(),
+                    sioc=SIOC, dcterms=DCTERMS, content=CONTENT)),
+        }
+
+def fill(coll, n):
+    coll.drop()
+    start = datetime.datetime(2000, 1, 1, tzinfo=tzlocal())
+    batch = []
+    for i in range(n):
+        batch.append(syntheticDoc(i, start + datetime.timedelta(seconds=i)))
+        if len(batch) >= 5000:
+            coll.insert(batch)
+            batch = []
+    if batch:
+        coll.insert(batch)
+    coll.ensure_index('created')
+
+def writeOne(db):
+    now = datetime.datetime.now(tzlocal()).replace(microsecond=0)
+    parent = URIRef("http://example.com/post/new")
+    comment = URIRef("http://bigasterisk.com/comment/bench-new-%s" % time.time())
+    created = Literal(now.isoformat(), datatype=URIRef("http://www.w3.org/2001/XMLSchema#dateTime"))
+    db.writeFile([(parent, SIOC.has_reply, comment),
+                  (comment, DCTERMS.created, created),
+                  (comment, CONTENT.encoded, Literal("new", datatype=RDF.XMLLiteral))],
+                 URIRef(parent + "/comments"), fileWords=['new'])
+
+def readLatency(db):
+    t1 = time.time()
+    db.value(URIRef("http://example.com/post/new"), SIOC.has_reply)
+    return time.time() - t1
+
+def fillColumnar(path, n):
+    db = DbColumnar(path)
+    start = datetime.datetime(2000, 1, 1, tzinfo=tzlocal())
+    for i in range(n):
+        db.saveComment(URIRef("http://example.com/post/%d" % (i % 1000)),
+                       URIRef("http://bigasterisk.com/comment/bench%d" % i),
+                       start + datetime.timedelta(seconds=i),
+                       URIRef("http://bigasterisk.com/guest/bench%d" % i),
+                       u"comment number %d" % i, u"comment number %d" % i)
+
+def rssMb():
+    for line in open("/proc/self/status"):
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) / 1024.
+
+def measureInChild(makeDb):
+    """load a store in a forked process, so each one starts from the same rss"""
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    before = rssMb()
+    t1 = time.time()
+    db = makeDb()
+    db.getCommentCount(URIRef("http://example.com/post/0"))
+    load = time.time() - t1
+    t1 = time.time()
+    for i in range(1000):
+        db.getCommentsForParent(URIRef("http://example.com/post/%d" % i))
+    lookup = (time.time() - t1) / 1000
+    print "%-12s load %8.2f s, +%8.1f MB rss, comments for one post %8.3f ms" % (
+        db.__class__.__name__, load, rssMb() - before, 1000 * lookup)
+    os._exit(0)
+
+def compareStores(mongo, access, n):
+    fill(mongo['comment'], n)
+    measureInChild(lambda: DbMongo(mongo, accessFile=access))
+    path = tempfile.mkdtemp()
+    try:
+        fillColumnar(path, n)
+        measureInChild(lambda: DbColumnar(path, accessFile=access))
+    finally:
+        shutil.rmtree(path)
+
+def compareStartup(mongo, access, n):
+    fill(mongo['comment'], n)
+    snapshot = tempfile.NamedTemporaryFile(suffix=".pickle")
+    t1 = time.time()
+    db = DbMongo(mongo, accessFile=access)
+    db.sync()
+    cold = time.time() - t1
+    db.saveSnapshot(snapshot.name)
+    for i in range(10):
+        writeOne(db)
+
+    t1 = time.time()
+    db = DbMongo(mongo, accessFile=access)
+    db.loadSnapshot(snapshot.name)
+    db.sync()
+    warm = time.time() - t1
+    print "%8d comments: parse everything %8.2f s, snapshot + 10 new %8.2f s" % (
+        n, cold, warm)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--host", default="localhost")
+    parser.add_option("--sizes", default="10000,100000,1000000")
+    parser.add_option("--columnar", action="store_true",
+                      help="compare DbMongo and DbColumnar instead")
+    parser.add_option("--startup", action="store_true",
+                      help="compare cold and snapshot startup instead")
+    opts, args = parser.parse_args()
+
+    from pymongo import Connection
+    mongo = Connection(opts.host, 27017, tz_aware=True)['comment_bench']
+    access = tempfile.NamedTemporaryFile(suffix=".n3")
+    access.write("<http://bigasterisk.com/foaf.rdf#drewp> <http://xmlns.com/foaf/0.1/name> \"drewp\" .\n")
+    access.flush()
+
+    for n in [int(s) for s in opts.sizes.split(',')]:
+        if opts.columnar:
+            print "%d comments:" % n
+            compareStores(mongo, access.name, n)
+            continue
+        if opts.startup:
+            compareStartup(mongo, access.name, n)
+            continue
+        fill(mongo['comment'], n)
+        for incremental in [True, False]:
+            db = DbMongo(mongo, accessFile=access.name, incremental=incremental)
+            t1 = time.time()
+            db.getGraph()
+            load = time.time() - t1
+            writeOne(db)
+            print "%8d comments, %-11s: first load %8.2f s, read after write %8.2f ms" % (
+                n, "incremental" if incremental else "full", load,
+                1000 * readLatency(db))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+"""
+load test of the whole HTTP service, for checking a change for
+regressions. Builds a synthetic comment log (DbLog, so no mongo or
+network is needed), serves it with Application in a child process, and
+drives a mix of requests at it:
+
+  read   GET /public/comments?post=...
+  count  GET /public/commentCount?post=...
+  post   POST /public/comments
+  root   GET /
+
+then prints p50/p99 latency per kind and requests/sec.
+
+  bin/python bench_http.py [--comments 5000] [--posts 500] [--requests 5000]
+                           [--save baseline.json] [--compare baseline.json]
+
+--compare exits 1 if anything got more than --tolerance worse than the
+saved run. Only compare runs with the same options on the same machine.
+"""
+import os, sys, json, time, random, tempfile, shutil, urllib, zlib
+import optparse, subprocess
+from rdflib import URIRef, Literal, RDF
+from twisted.internet import reactor, defer
+from twisted.web.client import getPage
+
+os.chdir(os.path.dirname(os.path.abspath(__file__))) # for the templates
+
+from commentServe import (Application, newPublicUser, newCommentUri,
+                          commentStatements, literalFromUnix, SIOC, DCTERMS)
+from logstore import DbLog, ENTRY, dumpDoc, writeFile
+from ratelimit import RateLimiter
+from db import commentDoc
+from sanitize import sanitize_html
+
+WORDS = (u"the a comment post thanks great photo really like this one "
+         u"we went there last year and it was nice i think you should try "
+         u"again with the other lens maybe next time").split()
+
+def threadLengths(comments, posts, dist, rand):
+    """how many comments each post gets"""
+    if dist == 'uniform':
+        weights = [1] * posts
+    else: # a few long threads and many short ones, like the real site
+        weights = [1 / (i + 1.) for i in range(posts)]
+    total = sum(weights)
+    lengths = [0] * posts
+    for i in range(comments):
+        r = rand.random() * total
+        for p, w in enumerate(weights):
+            r -= w
+            if r <= 0:
+                break
+        lengths[p] += 1
+    return lengths
+
+def postUri(i):
+    return URIRef("http://example.com/post/%d" % i)
+
+def commentText(rand):
+    return u" ".join(rand.choice(WORDS) for w in range(rand.randrange(5, 80)))
+
+def fillLog(path, lengths, rand):
+    """
+    write the comments straight into a DbLog's files, since DbLog's
+    writeFile fsyncs every one
+    """
+    start = time.time() - 365 * 86400
+    lines, entries, offset = [], [], 0
+    for post, n in enumerate(lengths):
+        for i in range(n):
+            parent = postUri(post)
+            secs = start + rand.random() * 365 * 86400
+            comment = newCommentUri(secs)
+            user, stmts = newPublicUser("10.0.0.%d" % rand.randrange(256),
+                                        "guest%d" % rand.randrange(1000), "")
+            text = commentText(rand)
+            stmts.extend([(parent, SIOC.has_reply, comment),
+                          (comment, DCTERMS.created, literalFromUnix(secs)),
+                          (comment, SIOC.has_creator, user)])
+            stmts.extend(commentStatements(
+                user, comment, Literal(text, datatype=RDF.XMLLiteral)))
+            doc = commentDoc(stmts, URIRef(parent + "/comments"),
+                             sanitize_html(text))
+            doc['_id'] = "bench%d-%d" % (post, i)
+            line = json.dumps({'doc' : dumpDoc(doc)})
+            lines.append(line + "\n")
+            entries.append(ENTRY.pack(offset, len(line), zlib.crc32(line)))
+            offset += len(line) + 1
+    writeFile(os.path.join(path, "comments.log"), "".join(lines))
+    writeFile(os.path.join(path, "comments.idx"), "".join(entries))
+
+def startServer(path, accessFile):
+    """
+    a server on the log at path, in another process so it doesn't share
+    a cpu with the client. Returns (process, port)
+    """
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                             "--serve", path, accessFile],
+                            stdout=subprocess.PIPE)
+    return proc, int(proc.stdout.readline())
+
+def serve(path, accessFile):
+    db = DbLog(path, accessFile=accessFile)
+    # the bench posts far faster than any person would
+    app = Application(db, rateLimiter=RateLimiter(1e9, 10 ** 9, 1e9, 10 ** 9))
+    port = reactor.listenTCP(0, app, interface='127.0.0.1')
+    print port.getHost().port
+    sys.stdout.flush()
+    reactor.run()
+
+def requestMix(mix, posts, n, rand):
+    """n (kind, method, path, postdata) in a repeatable order"""
+    kinds = []
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        kinds.extend([kind] * int(weight))
+    for i in range(n):
+        kind = rand.choice(kinds)
+        post = postUri(rand.randrange(posts))
+        q = urllib.urlencode({'post' : post})
+        if kind == 'read':
+            yield kind, 'GET', '/public/comments?' + q, None
+        elif kind == 'count':
+            yield kind, 'GET', '/public/commentCount?' + q, None
+        elif kind == 'root':
+            yield kind, 'GET', '/', None
+        elif kind == 'post':
+            yield kind, 'POST', '/public/comments', urllib.urlencode(
+                {'post' : post, 'name' : 'bench',
+                 'content' : commentText(rand).encode('utf8')})
+        else:
+            raise ValueError("unknown request kind %r" % kind)
+
+@defer.inlineCallbacks
+def drive(port, requests, concurrency):
+    """returns ({kind : [secs, ...]}, errors, wall secs)"""
+    latencies, errors = {}, [0]
+    base = "http://127.0.0.1:%d" % port
+    def worker():
+        for kind, method, path, postdata in requests:
+            t1 = time.time()
+            try:
+                headers = {}
+                if postdata is not None:
+                    headers['Content-Type'] = 'application/x-www-form-urlencoded'
+                yield getPage(base + path, method=method, postdata=postdata,
+                              headers=headers)
+            except Exception, e:
+                errors[0] += 1
+                if errors[0] <= 5:
+                    print "%s %s failed: %s" % (method, path, e)
+                continue
+            latencies.setdefault(kind, []).append(time.time() - t1)
+    requests = iter(requests)
+    t1 = time.time()
+    yield defer.DeferredList([defer.inlineCallbacks(worker)()
+                              for i in range(concurrency)])
+    defer.returnValue((latencies, errors[0], time.time() - t1))
+
+def percentile(sortedValues, p):
+    return sortedValues[min(len(sortedValues) - 1,
+                            int(p / 100. * len(sortedValues)))]
+
+def summarize(latencies, errors, wall):
+    kinds = {}
+    for kind, secs in sorted(latencies.items()):
+        secs = sorted(secs)
+        kinds[kind] = dict(count=len(secs),
+                           p50ms=1000 * percentile(secs, 50),
+                           p99ms=1000 * percentile(secs, 99))
+    total = sum(k['count'] for k in kinds.values())
+    return dict(kinds=kinds, errors=errors, requestsPerSec=total / wall)
+
+def report(result):
+    for kind, k in sorted(result['kinds'].items()):
+        print "%-6s %6d requests  p50 %8.2f ms  p99 %8.2f ms" % (
+            kind, k['count'], k['p50ms'], k['p99ms'])
+    print "%.1f requests/sec, %d errors" % (result['requestsPerSec'],
+                                            result['errors'])
+
+def regressions(result, baseline, tolerance):
+    """descriptions of what got more than tolerance worse"""
+    worse = []
+    for kind, k in sorted(result['kinds'].items()):
+        old = baseline['kinds'].get(kind)
+        if old is None:
+            continue
+        for stat in ['p50ms', 'p99ms']:
+            if k[stat] > old[stat] * (1 + tolerance):
+                worse.append("%s %s %.2f ms, was %.2f ms" % (
+                    kind, stat, k[stat], old[stat]))
+    if result['requestsPerSec'] < baseline['requestsPerSec'] * (1 - tolerance):
+        worse.append("%.1f requests/sec, was %.1f" % (
+            result['requestsPerSec'], baseline['requestsPerSec']))
+    if result['errors'] > baseline['errors']:
+        worse.append("%d errors, was %d" % (result['errors'],
+                                            baseline['errors']))
+    return worse
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--comments", type="int", default=5000)
+    parser.add_option("--posts", type="int", default=500)
+    parser.add_option("--dist", default="zipf",
+                      help="thread lengths: zipf (a few long threads) or uniform")
+    parser.add_option("--requests", type="int", default=5000)
+    parser.add_option("--warmup", type="int", default=200)
+    parser.add_option("--concurrency", type="int", default=8)
+    parser.add_option("--mix", default="read=70,count=25,post=4,root=1",
+                      help="relative weights of each kind of request")
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--save", help="write the results to this json file")
+    parser.add_option("--compare", help="a json file from an earlier --save")
+    parser.add_option("--tolerance", type="float", default=.25,
+                      help="fraction worse than --compare that counts as "
+                      "a regression")
+    parser.add_option("--serve", action="store_true",
+                      help="(internal) serve the log dir and access file "
+                      "given as args")
+    opts, args = parser.parse_args()
+    if opts.serve:
+        serve(*args)
+        return
+
+    rand = random.Random(opts.seed)
+    path = tempfile.mkdtemp()
+    access = tempfile.NamedTemporaryFile(suffix=".n3")
+    access.write("<http://bigasterisk.com/foaf.rdf#drewp> "
+                 "<http://xmlns.com/foaf/0.1/name> \"drewp\" .\n")
+    access.flush()
+    server = None
+    try:
+        t1 = time.time()
+        lengths = threadLengths(opts.comments, opts.posts, opts.dist, rand)
+        fillLog(path, lengths, rand)
+        print "wrote %d comments on %d posts (longest thread %d) in %.1f sec" % (
+            opts.comments, opts.posts, max(lengths), time.time() - t1)
+        server, port = startServer(path, access.name)
+
+        warmup = list(requestMix(opts.mix, opts.posts, opts.warmup, rand))
+        requests = list(requestMix(opts.mix, opts.posts, opts.requests, rand))
+        results = []
+        d = drive(port, warmup, opts.concurrency)
+        d.addCallback(lambda _: drive(port, requests, opts.concurrency))
+        d.addCallback(results.append)
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(path)
+
+    if not results:
+        sys.exit(1)
+    result = summarize(*results[0])
+    result['options'] = dict((k, getattr(opts, k)) for k in [
+        'comments', 'posts', 'dist', 'requests', 'concurrency', 'mix', 'seed'])
+    report(result)
+    if opts.save:
+        with open(opts.save, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if opts.compare:
+        baseline = json.load(open(opts.compare))
+        if baseline.get('options') != result['options']:
+            print "warning: %s was run with other options" % opts.compare
+        worse = regressions(result, baseline, opts.tolerance)
+        for w in worse:
+            print "regression: %s" % w
+        if worse:
+            sys.exit(1)
+        print "no regressions against %s" % opts.compare
+
+if __name__ == '__main__':
+    main()
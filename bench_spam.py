@@ -0,0 +1,88 @@
+#!/usr/bin/python
+"""
+spam checks per second, for the old chain of string checks vs.
+SpamRules with spamrules.conf, over a corpus built from the
+commentServe_test.py cases plus generated spam and ordinary comments.
+
+  bin/python bench_spam.py [--n 20000]
+"""
+import time, random, optparse
+from rdflib import URIRef
+from spamfilter import SpamRules
+
+# the commentServe_test.py cases
+TEST_CASES = [
+    u"this message is fine",
+    u"you can say http://example.com/ a link if you need to",
+    u'<a href="not even">a single html</a> link is currently allowed',
+    u"too many spammers were doing this http://dumbsite.com",
+    ]
+
+WORDS = (u"the a comment post thanks great photo really like this one "
+         u"we went there last year and it was nice i think you should try "
+         u"again with the other lens maybe next time").split()
+
+SPAM = [
+    u"Cheap VIAGRA and Cialis without prescription, fast shipping",
+    u"[url=http://pills.example.com]best pilules[/url] for you",
+    u'Great site! <a href="http://casino.example.com">casino</a>',
+    u"Probleme de sante? Our pfizer products help",
+    u"nice post, visit my page http://seo.example.com/cheap-stuff",
+    ]
+
+def chainedCheck(article, content):
+    """spamCheck as it was before SpamRules, for comparison"""
+    if content.lower().count("<a href") > 0:
+        raise ValueError("too many links")
+    if '[url=' in content:
+        raise ValueError("url markup is too suspicious")
+    if content.split()[-1].startswith(('http://', 'https://')):
+        raise ValueError("please don't end with a link")
+    if article in [URIRef("http://drewp.quickwitretort.com/2008/02/22/0"),
+                   URIRef("http://drewp.quickwitretort.com/2010/07/03/0"),
+                   ]:
+        raise ValueError("spam flood")
+    for pat in ['viagra', 'cialis', 'probleme de sante', 'pfizer', 'pilules']:
+        if pat in content.lower():
+            raise ValueError("spam pattern")
+
+def corpus(n, spamFraction=.3, seed=1):
+    """(article, content) pairs; the ordinary ones are a few sentences long"""
+    rand = random.Random(seed)
+    ret = []
+    for i in range(n):
+        article = URIRef("http://example.com/post/%d" % rand.randrange(500))
+        if rand.random() < spamFraction:
+            content = rand.choice(SPAM)
+        elif rand.random() < .1:
+            content = rand.choice(TEST_CASES)
+        else:
+            content = u" ".join(rand.choice(WORDS)
+                                for w in range(rand.randrange(10, 200)))
+        ret.append((article, content))
+    return ret
+
+def rate(check, comments):
+    rejected = 0
+    t1 = time.time()
+    for article, content in comments:
+        try:
+            check(article, content)
+        except ValueError:
+            rejected += 1
+    return len(comments) / (time.time() - t1), rejected
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--n", type="int", default=20000)
+    opts, args = parser.parse_args()
+    comments = corpus(opts.n)
+    rules = SpamRules()
+    for name, check in [("chained checks", chainedCheck),
+                        ("SpamRules", rules.check)]:
+        perSec, rejected = rate(check, comments)
+        print "%-15s %10.0f checks/sec, %5d of %d rejected" % (
+            name, perSec, rejected, len(comments))
+
+if __name__ == '__main__':
+    main()
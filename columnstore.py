@@ -0,0 +1,374 @@
+"""
+comment store that keeps each comment as one row of small numbers
+instead of a pile of rdflib triples. Parent and creator URIs are
+interned to ints, timestamps live in an array, and strings are in a
+blob file that we read through mmap. The RDF graph is only built if
+someone asks for it.
+
+Files in the store directory:
+  uris.txt      one interned URI per line; line number is the id
+  rows.bin      one ROW record per comment, in the order they were saved
+  content.blob  utf8 strings that rows point into
+  names.txt     'creatorId<tab>name' lines
+"""
+import os, mmap, struct, heapq, bisect, datetime, time, logging
+from array import array
+from dateutil.parser import parse
+from dateutil.tz import tzlocal
+from rdflib import URIRef, Literal, RDF
+from rdflib.graph import ConjunctiveGraph, Graph
+from rdflib.parser import StringInputSource
+from sanitize import sanitize_html
+from db import (_shared, page, docDigest, SIOC, CONTENT, DCTERMS, XS, FOAF,
+                ACCESS_FILE)
+
+log = logging.getLogger("db")
+
+# created, parent, creator, then (offset, length) blob spans for each
+# of SPANS, then the spam flag
+ROW = struct.Struct("<dii" + "qi" * 4 + "B")
+SPAM_OFFSET = ROW.size - 1
+COMMENT_URI, CONTENT_RAW, CONTENT_HTML, EXTRA_TRIPLES = SPANS = range(4)
+
+class DbColumnar(_shared):
+    def __init__(self, path="columnstore", accessFile=ACCESS_FILE):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.accessFile = accessFile
+
+        self.uris = [] # id : unicode
+        self.uriIds = {} # unicode : id
+        self.names = {} # creatorId : unicode
+
+        self.created = array('d')
+        self.parent = array('i')
+        self.creator = array('i')
+        self.spam = array('b')
+        self.spans = array('l') # offset, length for each of SPANS per row
+
+        self.byParent = {} # parentId : array of rows, in created order
+        self.byCreator = None # like byParent; built when it's first needed
+        self.counts = {} # parentId : non-spam comments
+        self.digests = {} # parentId : xor of docDigest of non-spam rows
+
+        self._load()
+        self.blob = open(os.path.join(path, "content.blob"), "ab")
+        self.blobReader = open(os.path.join(path, "content.blob"), "rb")
+        self.rowFile = open(os.path.join(path, "rows.bin"), "r+b")
+        self.uriFile = open(os.path.join(path, "uris.txt"), "a")
+        self.nameFile = open(os.path.join(path, "names.txt"), "a")
+        self.blobMap = None
+        self.exported = None # graph from getGraph, until the next change
+        self.exportedAccessMtime = None
+        self.accessNames = {} # uri : name, from access.n3
+        self.accessMtime = None
+
+    def _load(self):
+        t1 = time.time()
+        for name in ["uris.txt", "names.txt", "rows.bin", "content.blob"]:
+            open(os.path.join(self.path, name), "ab").close()
+        for line in open(os.path.join(self.path, "uris.txt")):
+            self._internNew(line.rstrip("\n").decode('utf8'))
+        for line in open(os.path.join(self.path, "names.txt")):
+            creatorId, name = line.rstrip("\n").decode('utf8').split("\t", 1)
+            self.names[int(creatorId)] = name
+        rowPath = os.path.join(self.path, "rows.bin")
+        rows = open(rowPath, "rb").read()
+        for i in range(len(rows) // ROW.size):
+            self._appendRow(ROW.unpack_from(rows, i * ROW.size))
+        end = len(self.created) * ROW.size
+        if end < len(rows):
+            # or the next row would go after them, and every row from
+            # there on would be read at the wrong offset
+            log.warn("dropping %s bytes of an unfinished row from %s" %
+                     (len(rows) - end, rowPath))
+            with open(rowPath, "r+b") as f:
+                f.truncate(end)
+        log.info("loaded %s comments from %s in %f sec" %
+                 (len(self.created), self.path, time.time() - t1))
+
+    def _internNew(self, uri):
+        self.uriIds[uri] = len(self.uris)
+        self.uris.append(uri)
+
+    def _intern(self, uri):
+        uri = unicode(uri)
+        try:
+            return self.uriIds[uri]
+        except KeyError:
+            self._internNew(uri)
+            self.uriFile.write(uri.encode('utf8') + "\n")
+            self.uriFile.flush()
+            return self.uriIds[uri]
+
+    def _appendRow(self, fields):
+        row = len(self.created)
+        created, parentId, creatorId = fields[:3]
+        isSpam = fields[-1]
+        self.created.append(created)
+        self.parent.append(parentId)
+        self.creator.append(creatorId)
+        self.spans.extend(fields[3:-1])
+        self.spam.append(isSpam)
+        self._addToIndex(self.byParent, parentId, row)
+        if self.byCreator is not None:
+            self._addToIndex(self.byCreator, creatorId, row)
+        if not isSpam:
+            self.counts[parentId] = self.counts.get(parentId, 0) + 1
+            self._changed(parentId, row)
+        return row
+
+    def _changed(self, parentId, row):
+        self.digests[parentId] = (self.digests.get(parentId, 0) ^
+                                  docDigest(str(row)))
+
+    def _addToIndex(self, index, key, row):
+        rows = index.setdefault(key, array('i'))
+        created = self.created[row]
+        if rows and created < self.created[rows[-1]]:
+            pos = bisect.bisect([self.created[r] for r in rows], created)
+            rows.insert(pos, row)
+        else:
+            rows.append(row)
+
+    def _creatorIndex(self):
+        if self.byCreator is None:
+            self.byCreator = {}
+            for row in xrange(len(self.created)):
+                self._addToIndex(self.byCreator, self.creator[row], row)
+        return self.byCreator
+
+    def _writeBlob(self, s):
+        data = s.encode('utf8')
+        self.blob.seek(0, 2)
+        offset = self.blob.tell()
+        self.blob.write(data)
+        return offset, len(data)
+
+    def _span(self, row, which):
+        i = (row * len(SPANS) + which) * 2
+        return self._readBlob(self.spans[i], self.spans[i + 1])
+
+    def _readBlob(self, offset, length):
+        if length == 0:
+            return u""
+        if self.blobMap is None or offset + length > len(self.blobMap):
+            self.blob.flush()
+            self.blobMap = mmap.mmap(self.blobReader.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        return self.blobMap[offset:offset + length].decode('utf8')
+
+    def saveComment(self, parent, comment, created, creator, content, html,
+                    creatorName=None, extraTriples=u""):
+        """
+        created is a datetime. extraTriples is n-triples text for
+        anything else that should come back in the rdf export (like
+        the public user's headers).
+
+        returns docId
+        """
+        if creatorName is not None:
+            creatorId = self._intern(creator)
+            if self.names.get(creatorId) != creatorName:
+                self.names[creatorId] = unicode(creatorName)
+                self.nameFile.write(("%d\t%s\n" % (
+                    creatorId, creatorName.replace("\n", " "))).encode('utf8'))
+                self.nameFile.flush()
+        spans = (self._writeBlob(unicode(comment)) + self._writeBlob(content) +
+                 self._writeBlob(html) + self._writeBlob(extraTriples))
+        self.blob.flush()
+        fields = ((unixTime(created), self._intern(parent),
+                   self._intern(creator)) + spans + (0,))
+        self.rowFile.seek(0, 2)
+        self.rowFile.write(ROW.pack(*fields))
+        self.rowFile.flush()
+        self.exported = None
+        return str(self._appendRow(fields))
+
+    def setSpam(self, docId, isSpam):
+        """returns the parent of the comment"""
+        row = int(docId)
+        if bool(self.spam[row]) != isSpam:
+            self.spam[row] = int(isSpam)
+            self.rowFile.seek(row * ROW.size + SPAM_OFFSET)
+            self.rowFile.write(chr(int(isSpam)))
+            self.rowFile.flush()
+            parentId = self.parent[row]
+            self.counts[parentId] += -1 if isSpam else 1
+            self._changed(parentId, row)
+            self.exported = None
+        return URIRef(self.uris[self.parent[row]])
+
+    def _loadAccessNames(self):
+        """logged-in users' names come from access.n3"""
+        mtime = os.path.getmtime(self.accessFile)
+        if mtime == self.accessMtime:
+            return
+        g = ConjunctiveGraph()
+        g.parse(self.accessFile, format="n3")
+        self.accessNames = dict((unicode(s), o) for s, o in
+                                g.subject_objects(FOAF.name))
+        self.accessMtime = mtime
+
+    def _nameOf(self, uri):
+        """call _loadAccessNames first"""
+        try:
+            return self.accessNames[uri]
+        except KeyError:
+            name = self.names.get(self.uriIds.get(uri))
+            return Literal(name) if name is not None else None
+
+    def _row(self, row):
+        """(created, creatorName, html, docId, creator) like db.CommentIndex"""
+        creator = self.uris[self.creator[row]]
+        return (datetime.datetime.fromtimestamp(self.created[row], tzlocal()),
+                self._nameOf(creator),
+                self._span(row, CONTENT_HTML),
+                str(row), URIRef(creator))
+
+    def _rowsFor(self, index, uri):
+        try:
+            return index[self.uriIds[unicode(uri)]]
+        except KeyError:
+            return ()
+
+    def getCommentsForParent(self, parent, withSpam=False, limit=None,
+                             before=None, after=None):
+        self._loadAccessNames()
+        rows = page(self._rowsFor(self.byParent, parent),
+                    self.created.__getitem__, limit,
+                    before and unixTime(before), after and unixTime(after),
+                    keep=None if withSpam else lambda r: not self.spam[r])
+        return [self._row(r) for r in rows]
+
+    def getCommentCount(self, parent):
+        return self.counts.get(self.uriIds.get(unicode(parent)), 0)
+
+    def getCommentVersion(self, parent):
+        self._loadAccessNames()
+        parentId = self.uriIds.get(unicode(parent))
+        rows = self._rowsFor(self.byParent, parent)
+        return "%s-%s-%s-%x" % (
+            self.accessMtime, self.created[rows[-1]] if rows else None,
+            self.counts.get(parentId, 0), self.digests.get(parentId, 0))
+
+    def getNewestCommentTime(self, parents):
+        newest = None
+        for parent in parents:
+            for r in reversed(self._rowsFor(self.byParent, parent)):
+                if not self.spam[r]:
+                    newest = max(newest, self.created[r])
+                    break
+        if newest is None:
+            return None
+        return datetime.datetime.fromtimestamp(newest, tzlocal())
+
+    def getCommentsByUser(self, user, withSpam=False, limit=None,
+                          before=None, after=None):
+        """
+        (created, creatorName, html, docId, creator, parent) rows,
+        newest first; paging as in getCommentsForParent
+        """
+        self._loadAccessNames()
+        rows = page(self._rowsFor(self._creatorIndex(), user),
+                    self.created.__getitem__, limit,
+                    before and unixTime(before), after and unixTime(after),
+                    keep=None if withSpam else lambda r: not self.spam[r])
+        return [self._row(r) + (URIRef(self.uris[self.parent[r]]),)
+                for r in reversed(rows)]
+
+    def getRecentComments(self, n=10, notOlderThan=None, withSpam=False):
+        self._loadAccessNames()
+        oldest = 0
+        if notOlderThan is not None:
+            oldest = time.time() - notOlderThan * 86400
+        rows = (r for r in xrange(len(self.created))
+                if self.created[r] > oldest and (withSpam or not self.spam[r]))
+        for r in heapq.nlargest(n, rows, key=self.created.__getitem__):
+            created, _, _, docId, creator = self._row(r)
+            yield dict(
+                uri=URIRef(self._span(r, COMMENT_URI)),
+                parent=URIRef(self.uris[self.parent[r]]),
+                created=created,
+                content=self._span(r, CONTENT_RAW),
+                creator=creator,
+                docId=docId,
+                isSpam='spam' if self.spam[r] else '')
+
+    def writeFile(self, stmts, ctx, fileWords, html=None):
+        """save a comment given as the statements commentServe makes"""
+        comment = [s for s in stmts if s[1] == SIOC.has_reply][0][2]
+        parent = [s for s in stmts if s[1] == SIOC.has_reply][0][0]
+        fields = {}
+        extra = []
+        for s, p, o in stmts:
+            if s == comment and p in [DCTERMS.created, SIOC.has_creator,
+                                      CONTENT.encoded]:
+                fields[p] = o
+            elif p != SIOC.has_reply:
+                extra.append((s, p, o))
+        creator = fields[SIOC.has_creator]
+        names = [o for s, p, o in extra if s == creator and p == FOAF.name]
+        if html is None:
+            html = sanitize_html(fields[CONTENT.encoded])
+        return self.saveComment(
+            parent, comment, parse(fields[DCTERMS.created]), creator,
+            fields[CONTENT.encoded], html,
+            creatorName=names[0] if names else None,
+            extraTriples=u"".join(u"%s %s %s .\n" % (s.n3(), p.n3(), o.n3())
+                                  for s, p, o in extra))
+
+    def setType(self, docId, type):
+        return self.setSpam(docId, type == "spam")
+
+    def setTypes(self, docIds, type):
+        return set(self.setType(docId, type) for docId in docIds)
+
+    def value(self, subject=None, predicate=RDF.value, *args, **kw):
+        # names are the only lookup the web pages do; answer those
+        # without building the graph
+        if (subject is not None and predicate == FOAF.name and
+            not args and not kw):
+            self._loadAccessNames()
+            return self._nameOf(unicode(subject))
+        return _shared.value(self, subject, predicate, *args, **kw)
+
+    def getGraph(self):
+        """rdf export of the non-spam comments, plus access.n3"""
+        mtime = os.path.getmtime(self.accessFile)
+        if self.exported is not None and mtime == self.exportedAccessMtime:
+            return self.exported
+        g = ConjunctiveGraph()
+        g.parse(self.accessFile, format="n3")
+        ctx = g.default_context
+        for r in xrange(len(self.created)):
+            if self.spam[r]:
+                continue
+            comment = URIRef(self._span(r, COMMENT_URI))
+            g.add((URIRef(self.uris[self.parent[r]]), SIOC.has_reply, comment))
+            g.add((comment, DCTERMS.created, Literal(
+                datetime.datetime.fromtimestamp(
+                    self.created[r], tzlocal()).isoformat(),
+                datatype=XS['dateTime'])))
+            g.add((comment, SIOC.has_creator,
+                   URIRef(self.uris[self.creator[r]])))
+            g.add((comment, CONTENT.encoded, Literal(
+                self._span(r, CONTENT_RAW),
+                datatype=RDF.XMLLiteral)))
+            extra = self._span(r, EXTRA_TRIPLES)
+            if extra:
+                # ConjunctiveGraph.parse would scan the whole store to
+                # clear its new context, so parse on the side and add
+                extraGraph = Graph()
+                extraGraph.parse(StringInputSource(extra.encode('utf8')),
+                                 format="nt")
+                g.addN((s, p, o, ctx) for s, p, o in extraGraph)
+        for creatorId, name in self.names.items():
+            g.add((URIRef(self.uris[creatorId]), FOAF.name, Literal(name)))
+        self.exported = g
+        self.exportedAccessMtime = mtime
+        return g
+
+def unixTime(dt):
+    return time.mktime(dt.astimezone(tzlocal()).timetuple()) + dt.microsecond / 1e6
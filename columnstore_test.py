@@ -0,0 +1,102 @@
+import unittest, tempfile, shutil, datetime, os
+from dateutil.tz import tzlocal
+from rdflib import URIRef, Literal
+from columnstore import DbColumnar
+from db import SIOC, FOAF
+
+post = URIRef("http://example.com/post")
+user = URIRef("http://example.com/user")
+
+def when(minute):
+    return datetime.datetime(2013, 1, 1, 12, minute, tzinfo=tzlocal())
+
+class TestDbColumnar(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.access = tempfile.NamedTemporaryFile(suffix=".n3")
+        self.access.write('<http://example.com/admin> '
+                          '<http://xmlns.com/foaf/0.1/name> "admin" .\n')
+        self.access.flush()
+        self.db = self.open()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        return DbColumnar(self.dir, accessFile=self.access.name)
+
+    def save(self, minute, parent=post, creator=user, name=None):
+        return self.db.saveComment(
+            parent, URIRef("http://example.com/c%s" % minute), when(minute),
+            creator, u"raw %s" % minute, u"<p>%s</p>" % minute,
+            creatorName=name)
+
+    def testCommentsComeBackInOrderAfterReopen(self):
+        self.save(5, name=u"bob")
+        self.save(1, creator=URIRef("http://example.com/admin"))
+        self.db = self.open()
+        rows = self.db.getCommentsForParent(post)
+        self.assertEqual([(r[1], r[2]) for r in rows],
+                         [(Literal("admin"), u"<p>1</p>"),
+                          (Literal("bob"), u"<p>5</p>")])
+        self.assertEqual(rows[0][0], when(1))
+        self.assertEqual(self.db.getCommentCount(post), 2)
+
+    def testNewestCommentTimeSkipsSpam(self):
+        other = URIRef("http://example.com/other")
+        self.save(1)
+        self.save(3, parent=other)
+        spam = self.save(7)
+        self.db.setSpam(spam, True)
+        self.assertEqual(self.db.getNewestCommentTime([post]), when(1))
+        self.assertEqual(self.db.getNewestCommentTime([post, other]), when(3))
+        self.assertEqual(self.db.getNewestCommentTime([]), None)
+
+    def testSpamIsPersisted(self):
+        docId = self.save(1)
+        self.save(2)
+        self.assertEqual(self.db.setSpam(docId, True), post)
+        self.db = self.open()
+        self.assertEqual(self.db.getCommentCount(post), 1)
+        self.assertEqual(len(self.db.getCommentsForParent(post, withSpam=True)), 2)
+        recent = list(self.db.getRecentComments(10, withSpam=True))
+        self.assertEqual([r['isSpam'] for r in recent], ['', 'spam'])
+
+    def testUnfinishedRowIsDropped(self):
+        self.save(1)
+        with open(os.path.join(self.dir, "rows.bin"), "ab") as f:
+            f.write("\0" * 7)
+        self.db = self.open()
+        docId = self.save(2)
+        self.db = self.open()
+        self.assertEqual(self.db.getCommentCount(post), 2)
+        self.db.setSpam(docId, True)
+        self.db = self.open()
+        self.assertEqual([r[2] for r in self.db.getCommentsForParent(post)],
+                         [u"<p>1</p>"])
+
+    def testCommentsByUserPaging(self):
+        for m in range(10):
+            self.save(m)
+        page = self.db.getCommentsByUser(user, limit=3)
+        self.assertEqual([r[0] for r in page], [when(9), when(8), when(7)])
+        page = self.db.getCommentsByUser(user, before=when(7), limit=3)
+        self.assertEqual([r[0] for r in page], [when(6), when(5), when(4)])
+
+    def testRdfExport(self):
+        self.save(1, name=u"bob")
+        g = self.db.getGraph()
+        self.assertEqual(len(list(g.objects(post, SIOC.has_reply))), 1)
+        self.assertEqual(self.db.value(user, FOAF.name), Literal("bob"))
+
+    def testRdfExportIncludesExtraTriples(self):
+        for minute in range(3):
+            self.db.saveComment(
+                post, URIRef("http://example.com/c%s" % minute), when(minute),
+                user, u"raw", u"<p>raw</p>",
+                extraTriples=u'<http://example.com/c%s> '
+                u'<http://example.com/ip> "10.0.0.%s" .\n' % (minute, minute))
+        g = self.db.getGraph()
+        self.assertEqual(g.value(URIRef("http://example.com/c2"),
+                                 URIRef("http://example.com/ip")),
+                         Literal("10.0.0.2"))
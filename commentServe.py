@@ -13,20 +13,28 @@ see also:
 
 """
 
-import web, time, logging, pystache, traceback
+import web, time, logging, pystache, traceback, re, json, hashlib, urllib
+import calendar
 from datetime import datetime
 from uuid import uuid4
-from html5lib import html5parser, sanitizer
 from web.contrib.template import render_genshi
+from genshi.template import TemplateLoader
 from rdflib import RDF, URIRef, Literal, Namespace
 
 from dateutil.parser import parse
 from honeypot import HoneypotChecker
-import restkit
-from dateutil.tz import tzlocal
+from spamfilter import SpamRules, SpamFilter, HttpBl
+from ratelimit import RateLimiter
+from dateutil.tz import tzlocal, tzutc
 import cyclone.web
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
+from twisted.internet.interfaces import IPullProducer
+from zope.interface import implementer
 from db import DbMongo
+from sanitize import sanitize_html
+from fragmentcache import FragmentCache
+from alerts import AlertQueue
+import metrics
 
 SIOC = Namespace("http://rdfs.org/sioc/ns#")
 CONTENT = Namespace("http://purl.org/rss/1.0/modules/content/")
@@ -43,7 +51,8 @@ log.setLevel(logging.INFO)
 render = render_genshi(['.'], auto_reload=False)
 
 def literalFromUnix(t):
-    i = datetime.fromtimestamp(int(t)).replace(tzinfo=tzlocal()).isoformat()
+    # keep the fraction, so the created times we page by rarely tie
+    i = datetime.fromtimestamp(t).replace(tzinfo=tzlocal()).isoformat()
     return Literal(i, datatype=XS['dateTime'])
 
 
@@ -52,6 +61,41 @@ def agoString(literalTime):
     # (assuming 'now' is in the same timezone as d)
     return web.utils.datestr(d, datetime.now().replace(tzinfo=tzlocal()))
 
+def agoBucket(newest, now):
+    """
+    (bucket secs, bucket number) for unix time now, with buckets about
+    as long as the agoString texts of comments no newer than newest (a
+    datetime) stay the same. Etags that include this keep those texts
+    at most one bucket out of date
+    """
+    age = now - calendar.timegm(newest.utctimetuple())
+    for shorterThan, secs in [(60, 1), (3600, 60), (86400, 3600)]:
+        if age < shorterThan:
+            break
+    else:
+        secs = 86400
+    return secs, int(now // secs)
+
+# cached fragments hold these markers instead of agoString text, which
+# goes stale
+AGO_MARK = "ago-%s" % uuid4().hex
+agoPattern = re.compile(r"\{%s ([^}]+)\}" % AGO_MARK)
+
+def agoPlaceholder(when):
+    return "{%s %s}" % (AGO_MARK, when.isoformat())
+
+def fillAgoStrings(html):
+    return agoPattern.sub(lambda m: agoString(m.group(1)), html)
+
+def posterAddress(forwardedFor, remoteIp):
+    """
+    the address our proxy saw the post come from. It appends that to
+    X-Forwarded-For, and anything before it is whatever the client sent
+    """
+    if forwardedFor:
+        return forwardedFor.split(',')[-1].strip()
+    return remoteIp
+
 def newPublicUser(forwardedFor, name, email):
     """
     a non-logged-in user is posting a comment on a resource that's
@@ -84,44 +128,205 @@ def newCommentUri(secs=None):
         secs = time.time()
     return URIRef("http://bigasterisk.com/comment/%r" % secs)
 
-class AnyCase(sanitizer.HTMLSanitizer):
-    def __init__(self, stream, encoding=None, parseMeta=True, useChardet=True,
-                 lowercaseElementName=True, lowercaseAttrName=True):
-        sanitizer.HTMLSanitizer.__init__(self, stream, encoding, parseMeta,
-                                         useChardet,
-                                         lowercaseElementName,
-                                         lowercaseAttrName)
+defaultSpamRules = SpamRules()
+
+def spamCheck(article, content):
+    """raises ValueError if spamrules.conf says this is spam"""
+    defaultSpamRules.check(article, content)
 
-class AnyCaseNoSrc(AnyCase):
-    allowed_attributes = AnyCase.allowed_attributes[:]
-    allowed_attributes.remove('src')
+def toHttps(uri):
+    return uri.replace('http://', 'https://')
 
-def sanitize_html(stream, srcAttr=False):
-    ret = ''.join([token.toxml() for token in
-                   html5parser.HTMLParser(tokenizer=AnyCase if srcAttr else AnyCaseNoSrc).
-                   parseFragment(stream).childNodes])
-    return ret
+def templateRows(rows):
+    """the dicts comments.html wants, made as it asks for them"""
+    for when, who, content, docId, creator in rows:
+        yield dict(who=who, when=when, content=content)
+
+USER_PAGE_LIMIT = 50
+
+def userRows(rows):
+    """the dicts userComments.html wants, from getCommentsByUser rows"""
+    for when, who, content, docId, creator, parent in rows:
+        yield dict(who=who, when=when, content=content, docId=docId,
+                   parent=parent)
+
+def pageCursors(paging, rows):
+    """
+    (before, after) args for the pages older and newer than these
+    rows, which are in created order and came from a query with
+    paging. None where there's no page
+    """
+    if 'limit' not in paging or not rows:
+        return None, None
+    full = len(rows) >= paging['limit']
+    if 'after' in paging and 'before' not in paging: # paging forward
+        hasOlder, hasNewer = True, full
+    else:
+        hasOlder, hasNewer = full, 'before' in paging
+    return (cursor(rows[0][0]) if hasOlder else None,
+            cursor(rows[-1][0]) if hasNewer else None)
+
+def pageLinks(post, paging, rows):
+    """
+    (olderUri, newerUri) for the pages around these rows, which are
+    getCommentsForParent(post, **paging). None where there's no page
+    """
+    def link(**kw):
+        kw['limit'] = paging['limit']
+        return toHttps(post) + "/comments?" + urllib.urlencode(sorted(kw.items()))
+    before, after = pageCursors(paging, rows)
+    return (link(before=before) if before else None,
+            link(after=after) if after else None)
+
+def cursor(created):
+    """created time for a url; a '+' in an offset would come back as a space"""
+    return created.astimezone(tzutc()).isoformat().replace('+00:00', 'Z')
+
+STREAM_CHUNK_BYTES = 16 * 1024
+templates = TemplateLoader(['.'], auto_reload=False)
+
+@implementer(IPullProducer)
+class CommentStream(object):
+    """
+    renders comments.html(**kw) into write() about chunkBytes at a
+    time, each time the transport asks for more. done fires with True
+    when it's all written, or False if the client went away first
+    """
+    def __init__(self, write, chunkBytes=STREAM_CHUNK_BYTES, **kw):
+        self.write = write
+        self.chunkBytes = chunkBytes
+        self.pieces = templates.load("comments.html").generate(**kw).serialize()
+        self.renderSeconds = 0
+        self.done = defer.Deferred()
+
+    def resumeProducing(self):
+        if self.done.called:
+            return
+        t1 = time.time()
+        pending, size = [], 0
+        for s in self.pieces:
+            pending.append(s)
+            size += len(s)
+            if size >= self.chunkBytes:
+                break
+        else:
+            self.renderSeconds += time.time() - t1
+            self.write(u"".join(pending))
+            self.done.callback(True)
+            return
+        self.renderSeconds += time.time() - t1
+        self.write(u"".join(pending))
+
+    def stopProducing(self):
+        if not self.done.called:
+            self.done.callback(False)
+
+def streamComments(transport, write, chunkBytes=STREAM_CHUNK_BYTES, **kw):
+    """
+    like render.comments(**kw), but the output goes to write() in
+    pieces, each only after transport has sent the last one, so a post
+    with thousands of comments is never all in memory, here or in the
+    socket's buffer. Returns CommentStream.done
+    """
+    producer = CommentStream(write, chunkBytes, **kw)
+    def finished(ok):
+        transport.unregisterProducer()
+        metrics.observe('stage_seconds', producer.renderSeconds,
+                        stage='genshi_render')
+        return ok
+    producer.done.addCallback(finished)
+    transport.registerProducer(producer, False)
+    return producer.done
+
+class TimedHandler(cyclone.web.RequestHandler):
+    """counts and times every request, for /metrics"""
+    def _log(self):
+        handler = self.__class__.__name__
+        metrics.observe('request_seconds', self.request.request_time(),
+                        handler=handler, method=self.request.method)
+        metrics.count('requests_total', handler=handler,
+                      method=self.request.method, code=self._status_code)
+        cyclone.web.RequestHandler._log(self)
+
+class ConditionalGet(object):
+    """
+    Etags from the store's version of a post, so we can answer
+    If-None-Match before doing any rendering. cyclone would otherwise
+    make the Etag from a hash of the finished body
+    """
+    etag = None
+    showsAgo = False # whether the body has agoString texts
+
+
+    def checkVersion(self, post, public, *variant):
+        """
+        set the validators for this post. Returns True if the client
+        already has this version, in which case we've set a 304 and
+        you should write nothing. variant is whatever else the
+        response depends on
+        """
+        db = self.settings.db
+        version = db.getCommentVersion(post)
+        if version is None:
+            return False
+        newest = db.getNewestCommentTime([post])
+        if self.showsAgo and newest is not None:
+            # '3 minutes ago' changes without a new version
+            variant += (agoBucket(newest, time.time()),)
+        self.etag = '"%s"' % hashlib.md5(
+            repr((version, bool(public)) + variant)).hexdigest()
+        self.set_header("Etag", self.etag)
+        self.set_header("Vary", "X-Foaf-Agent")
+        if newest is not None:
+            self.set_header("Last-Modified", newest)
+        if public and self.settings.publicCacheControl:
+            self.set_header("Cache-Control", self.settings.publicCacheControl)
+
+        match = self.request.headers.get("If-None-Match", "")
+        if self.etag in match or match.strip() == "*":
+            self.set_status(304)
+            return True
+        return False
+
+    def writeBody(self, body):
+        """write the whole response, keeping our Etag"""
+        if self.etag is None:
+            self.write(body)
+            return
+        if isinstance(body, unicode):
+            body = body.encode('utf8')
+        self.set_header("Content-Length", len(body))
+        self.write(body)
+        # with the headers already sent, finish() won't replace the Etag
+        self.flush()
+
+class PagingArgs(object):
+    def pagingArgs(self):
+        """limit, before and after, as getCommentsForParent wants them"""
+        paging = {}
+        limit = self.get_argument("limit", default=None)
+        if limit:
+            paging['limit'] = int(limit)
+        for name in ['before', 'after']:
+            t = self.get_argument(name, default=None)
+            if t:
+                t = parse(t)
+                if t.tzinfo is None:
+                    t = t.replace(tzinfo=tzlocal())
+                paging[name] = t
+        return paging
+
+class Comments(ConditionalGet, PagingArgs, TimedHandler):
+    showsAgo = True
 
-def spamCheck(article, content):
-    if content.lower().count("<a href") > 0:
-        log.error("too many links in %r" % content)
-        raise ValueError("too many links")
-    if '[url=' in content:
-        raise ValueError("url markup is too suspicious")
-    if content.split()[-1].startswith(('http://', 'https://')):
-        raise ValueError("please don't end with a link")
-    if article in [URIRef("http://drewp.quickwitretort.com/2008/02/22/0"),
-                   URIRef("http://drewp.quickwitretort.com/2010/07/03/0"),
-                   ]:
-        raise ValueError("spam flood")
-    for pat in ['viagra', 'cialis', 'probleme de sante', 'pfizer', 'pilules']:
-        if pat in content.lower():
-            raise ValueError("spam pattern")
-
-class Comments(cyclone.web.RequestHandler):
     def get(self, public=False):
         """
         post=<uri to post> (or use 'uri' for the arg)
+        limit=<n> for just the newest n comments, or the n before
+          before=<created time> or after after=<created time>. The
+          page links to the ones around it.
+        stream=1 to send the comments as they're rendered, for posts
+          with thousands of them
         
         returns html formatted comments (until i get some more content types)
         """
@@ -140,40 +345,72 @@ class Comments(cyclone.web.RequestHandler):
                 self.write("Must login to see comments")
                 return
 
-        queryTime = time.time()
-        rows = self.findComments(post)
-        queryTime = time.time() - queryTime
+        includeJs = self.get_argument("js", default="0") != "0"
+        paging = self.pagingArgs()
+        stream = self.get_argument("stream", default="0") != "0"
+        if self.checkVersion(post, public, includeJs, foafAgent,
+                             sorted(paging.items()), stream):
+            return
+        you = self.settings.db.value(foafAgent, FOAF.name) if foafAgent else None
+        cacheKey = (post, bool(public), includeJs, you,
+                    tuple(sorted(paging.items())))
+
+        queryTime = 0
+        ret = None if stream else self.settings.fragmentCache.get(cacheKey)
+        if ret is None:
+            queryTime = time.time()
+            rows = self.findComments(post, paging)
+            queryTime = time.time() - queryTime
+
+            olderUri, newerUri = pageLinks(post, paging, rows)
+            args = dict(
+                includeJs=includeJs,
+                public=public,
+                parent=post,
+                toHttps=toHttps,
+                agoString=agoPlaceholder,
+                you=you,
+                rows=templateRows(rows),
+                olderUri=olderUri,
+                newerUri=newerUri,
+                )
+            if stream:
+                args['agoString'] = agoString
+                return self.streamBody(args, t1, queryTime)
+            with metrics.stage('genshi_render'):
+                ret = render.comments(**args)
+            self.settings.fragmentCache.put(cacheKey, post, ret)
 
         self.set_header("Content-Type", "text/html")
-        ret = render.comments(
-            includeJs=self.get_argument("js", default="0") != "0",
-            public=public,
-            parent=post,
-            toHttps=lambda uri: uri.replace('http://', 'https://'),
-            agoString=agoString,
-            you=self.settings.db.value(foafAgent, FOAF.name) if foafAgent else None,
-            rows=rows,
-            )
-        self.write(ret + "<!-- %.2f ms (%.2f ms in query) -->" % (
+        self.writeBody(fillAgoStrings(ret) + "<!-- %.2f ms (%.3f ms in query) -->" % (
             1000 * (time.time() - t1),
             1000 * queryTime))
 
-    def findComments(self, post):
-        rows = []
-        for who, when, content in self.settings.db.query("""
-               SELECT DISTINCT ?who ?when ?content WHERE {
-                 ?parent sioc:has_reply [
-                   sioc:has_creator ?cr;
-                   content:encoded ?content;
-                   dcterms:created ?when
-                   ]
-                 OPTIONAL { ?cr foaf:name ?who }
-               } ORDER BY ?when""", initBindings={"parent" : post}):
-            row = dict(who=who, when=when, content=sanitize_html(content))
-            rows.append(row)
+    def streamBody(self, args, t1, queryTime):
+        self.set_header("Content-Type", "text/html")
+        if not self.request.supports_http_1_1():
+            # 1.1 gets chunked encoding from cyclone, but for 1.0 there's
+            # no Content-Length, so the body ends where we hang up
+            self.set_header("Connection", "close")
+            self.request.connection.no_keep_alive = True
+        def write(s):
+            self.write(s)
+            self.flush()
+        transport = self.request.connection.transport
+        def done(ok):
+            if ok:
+                self.write("<!-- %.2f ms (%.3f ms in query), streamed -->" % (
+                    1000 * (time.time() - t1), 1000 * queryTime))
+            self.finish()
+        return streamComments(transport, write, **args).addCallback(done)
+
+    def findComments(self, post, paging):
+        with metrics.stage('findComments'):
+            rows = self.settings.db.getCommentsForParent(post, **paging)
         log.debug("found %s rows with parent %r" % (len(rows), post))
         return rows
     
+    @defer.inlineCallbacks
     def post(self, public=False):
         """
         post=<parent post>
@@ -186,19 +423,29 @@ class Comments(cyclone.web.RequestHandler):
         # maybe a legacy problem here with http/https, but blaster is still sending http
         parent = URIRef(parent)
 
-        # this might be failing on ariblog, but that one is already safe
+        # before anything costs us a lookup or a write
         ip = self.request.headers.get("X-Forwarded-For")
-        if ip is not None:
-            HoneypotChecker(open("priv-honeypotkey").read().strip()).check(ip)
+        poster = posterAddress(ip, self.request.remote_ip)
+        limited = self.settings.rateLimiter.check(poster, parent)
+        if limited is not None:
+            name, retryAfter = limited
+            log.info("comment on %s from %s over the %s rate limit" %
+                     (parent, poster, name))
+            # python's httplib doesn't know 429
+            self.set_status(503)
+            self.set_header("Retry-After", str(retryAfter))
+            self.write("too many comments; try again later")
+            return
 
         contentArg = self.get_argument("content", default="")
         if not contentArg.strip():
             raise ValueError("no text")
 
         if contentArg.strip() == 'test':
-            return "not adding test comment"
+            defer.returnValue("not adding test comment")
 
-        spamCheck(parent, contentArg)
+        # this might be failing on ariblog, but that one is already safe
+        yield self.settings.spamFilter.check(parent, contentArg, ip)
             
         content = Literal(contentArg, datatype=RDF.XMLLiteral)
 
@@ -232,7 +479,12 @@ class Comments(cyclone.web.RequestHandler):
                       ])
         stmts.extend(commentStatements(user, comment, content))
 
-        db.writeFile(stmts, ctx, fileWords=[parent.split('/')[-1], now])
+        yield self.settings.db.writeFile(stmts, ctx,
+                                         fileWords=[parent.split('/')[-1], now],
+                                         html=sanitize_html(contentArg.replace("\r", "")))
+        self.settings.fragmentCache.invalidateParent(parent)
+        if self.settings.peers is not None:
+            self.settings.peers.commentAdded(parent)
 
         try:
             self.sendAlerts(parent, user)
@@ -244,21 +496,11 @@ class Comments(cyclone.web.RequestHandler):
         self.write("added")
 
     def sendAlerts(self, parent, user):
-        c3po = restkit.Resource('http://bang:9040/')
-        for listener, mode in [
-            ('http://bigasterisk.com/foaf.rdf#drewp', 'xmpp'),
-            ('http://bigasterisk.com/kelsi/foaf.rdf#kelsi', 'xmpp')]:
-            c3po.post(
-                path='', payload={
-                    'user': listener,
-                    'msg': '%s comment from %s (http://10.1.0.1:9031/)' % (parent, user),
-                    'mode': mode,
-                },
-                # shouldn't this be automatic?
-                headers={'content-type' : 'application/x-www-form-urlencoded'},
-                )
+        if self.settings.alerts is not None:
+            self.settings.alerts.add(
+                '%s comment from %s (http://10.1.0.1:9031/)' % (parent, user))
             
-class CommentCount(cyclone.web.RequestHandler):
+class CommentCount(ConditionalGet, TimedHandler):
     def get(self, public=False):
         if not public:
             try:
@@ -269,26 +511,111 @@ class CommentCount(cyclone.web.RequestHandler):
                 return
 
         post = URIRef(self.get_argument("post"))
+        if self.checkVersion(post, public):
+            return
 
-        rows = self.settings.db.query("""
-               SELECT DISTINCT ?r WHERE {
-                 ?parent sioc:has_reply ?r
-               }""", initBindings={"parent" : post})
-        count = len(list(rows))
+        count = self.settings.db.getCommentCount(post)
         self.set_header("Content-Type", "text/plain")
-        self.write("%s comments" % count if count != 1 else "1 comment")
+        self.writeBody("%s comments" % count if count != 1 else "1 comment")
 
-class Root(cyclone.web.RequestHandler):
+class CommentCounts(TimedHandler):
+    """
+    post=<uri>&post=<uri>... as a GET or a form POST, for pages that
+    show counts for many posts. Returns json {post : count}. GETs get
+    an Etag from cyclone, which answers If-None-Match with 304
+    """
+    def get(self, public=False):
+        if not public:
+            try:
+                self.request.headers['X-Foaf-Agent']
+            except KeyError:
+                self.set_header("Content-Type", "text/plain")
+                self.write("Must login to see comments")
+                return
+
+        posts = [URIRef(p.decode('utf8').strip())
+                 for p in self.request.arguments.get("post", [])]
+        counts = self.settings.db.getCommentCounts(posts)
+        newest = self.settings.db.getNewestCommentTime(posts)
+        if newest is not None:
+            self.set_header("Last-Modified", newest)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(counts, sort_keys=True))
+
+    post = get
+
+class CommentsByUser(PagingArgs, TimedHandler):
     def get(self):
-        recent = self.settings.db.getRecentComments(10, notOlderThan=60,
+        """
+        user=<creator uri>
+        limit=<n> (default 50), before=<created time>, after=<created time>
+          for paging, as for /comments
+
+        returns that user's comments, newest first, as json, or with
+        format=html as a fragment with mark-spam buttons
+        """
+        if 'X-Foaf-Agent' not in self.request.headers:
+            self.write("Must login to see comments")
+            return
+        user = URIRef(self.get_argument("user"))
+        paging = self.pagingArgs()
+        paging.setdefault('limit', USER_PAGE_LIMIT)
+        with metrics.stage('findCommentsByUser'):
+            rows = self.settings.db.getCommentsByUser(user, **paging)
+
+        asHtml = self.get_argument("format", default="json") == "html"
+        def link(**kw):
+            kw.update(user=user.encode('utf8'), limit=paging['limit'])
+            if asHtml:
+                kw['format'] = 'html'
+            return "commentsByUser?" + urllib.urlencode(sorted(kw.items()))
+        before, after = pageCursors(paging, rows[::-1])
+        olderUri = link(before=before) if before else None
+        newerUri = link(after=after) if after else None
+
+        if asHtml:
+            self.set_header("Content-Type", "text/html")
+            with metrics.stage('genshi_render'):
+                self.write(render.userComments(
+                    user=user, rows=userRows(rows), olderUri=olderUri,
+                    newerUri=newerUri, agoString=agoString))
+            return
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(dict(
+            user=user,
+            comments=[dict(created=created.isoformat(), creatorName=who,
+                           html=html, docId=docId, parent=parent)
+                      for created, who, html, docId, creator, parent in rows],
+            older=olderUri,
+            newer=newerUri)))
+
+class Root(TimedHandler):
+    @defer.inlineCallbacks
+    def get(self):
+        recent = yield self.settings.db.getRecentComments(10, notOlderThan=60,
                                                     withSpam=False)
-        self.write(pystache.render(open("index.mustache").read(),
-                                   dict(recent=recent)))
+        self.write(self.settings.renderer.render(self.settings.indexTemplate,
+                                                 dict(recent=recent)))
 
-class Spam(cyclone.web.RequestHandler):
+class Spam(TimedHandler):
+    @defer.inlineCallbacks
     def post(self):
+        """
+        only=<docId> for one comment, or docId=<docId> repeated for
+        all the checked ones
+        """
+        only = self.get_argument('only', default=None)
+        if only:
+            docIds = [only]
+        else:
+            docIds = [i.decode('utf8').strip()
+                      for i in self.request.arguments.get('docId', [])]
         try:
-            self.settings.db.setType(docId=self.get_argument('docId'), type="spam")
+            parents = yield self.settings.db.setTypes(docIds, type="spam")
+            for parent in parents:
+                self.settings.fragmentCache.invalidateParent(parent)
+            if self.settings.peers is not None:
+                self.settings.peers.typesChanged(docIds, "spam")
         except Exception:
             traceback.print_exc()
             raise
@@ -300,34 +627,237 @@ def commentStatements(user, commentUri, realComment):
     realComment = Literal(realComment.replace("\r", ""), datatype=realComment.datatype) # rdflib n3 can't read these back
     return [(commentUri, CONTENT.encoded, realComment)]  
     
-class Index(cyclone.web.RequestHandler):
+class Stats(TimedHandler):
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(dict(
+            rateLimit=self.settings.rateLimiter.stats(),
+            spamRules=self.settings.spamFilter.fired,
+            fragmentCache=dict(hits=self.settings.fragmentCache.hits,
+                               misses=self.settings.fragmentCache.misses),
+            alerts=(self.settings.alerts.stats()
+                    if self.settings.alerts is not None else None),
+            )))
+
+class Metrics(TimedHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics.render())
+
+class Index(TimedHandler):
     def get(self):
         self.set_header("Content-Type", "text/plain")
         self.write("commentServe")
 
-class Fav(cyclone.web.RequestHandler):
+class Fav(TimedHandler):
     def get(self):
         self.write(open("favicon.ico").read())
 
 class Application(cyclone.web.Application):
-    def __init__(self, db):
+    def __init__(self, db, fragmentCache=None, honeypot=None, alerts=None,
+                 publicCacheControl=None, spamRules=None, rateLimiter=None,
+                 peers=None):
+        """
+        spamRules is a SpamRules (default reads spamrules.conf).
+        rateLimiter is a RateLimiter for new comments (default limits).
+        peers is a workers.Peers to tell the other workers about our
+        writes, or None if we're the only process.
+        honeypot is a HoneypotChecker, or None to skip that check.
+        alerts is an AlertQueue, or None to not announce new comments.
+        publicCacheControl is the Cache-Control header for the
+        /public/ comments and counts
+        """
         handlers = [
             (r'/comments', Comments),
             (r'/(public)/comments', Comments),
             (r'/commentCount', CommentCount),
             (r'/(public)/commentCount', CommentCount),
+            (r'/commentCounts', CommentCounts),
+            (r'/(public)/commentCounts', CommentCounts),
             (r'/', Root),
             (r'/favicon.ico', Fav),
             (r'/spam', Spam),
+            (r'/commentsByUser', CommentsByUser),
+            (r'/stats', Stats),
+            (r'/metrics', Metrics),
         ]
         cyclone.web.Application.__init__(self, handlers,
                                          db=db,
+                                         fragmentCache=fragmentCache or FragmentCache(),
+                                         spamFilter=SpamFilter(
+                                             [spamRules or defaultSpamRules] +
+                                             ([HttpBl(honeypot)] if honeypot else [])),
+                                         rateLimiter=rateLimiter or RateLimiter(),
+                                         peers=peers,
+                                         alerts=alerts,
+                                         publicCacheControl=publicCacheControl,
+                                         renderer=pystache.Renderer(),
+                                         indexTemplate=pystache.parse(
+                                             open("index.mustache").read().decode('utf8')),
                                          template_path=".")
+        if hasattr(db, 'onParentChanged'):
+            # comments can arrive from a background refresh
+            db.onParentChanged.append(
+                self.settings.fragmentCache.invalidateParent)
+        self.collectMetrics()
+
+    def collectMetrics(self):
+        """the counters other objects keep, for /metrics"""
+        s = self.settings
+        metrics.collect('fragment_cache_hits_total', 'counter',
+                        lambda: s.fragmentCache.hits)
+        metrics.collect('fragment_cache_misses_total', 'counter',
+                        lambda: s.fragmentCache.misses)
+        metrics.collect('spam_rejected_total', 'counter',
+                        lambda: s.spamFilter.fired, 'rule',
+                        help='comments refused, by the spam rule that fired')
+        metrics.collect('ratelimit_rejected_total', 'counter',
+                        lambda: s.rateLimiter.rejected, 'limit',
+                        help='comments refused for coming too fast')
+        metrics.collect('ratelimit_buckets', 'gauge',
+                        lambda: dict((name, len(b.buckets))
+                                     for name, b in s.rateLimiter.limits),
+                        'limit')
+        if s.peers is not None:
+            for name in ['sent', 'received', 'failed']:
+                metrics.collect('peer_messages_%s_total' % name, 'counter',
+                                lambda name=name: getattr(s.peers, name))
+        if hasattr(s.db, 'triples'):
+            metrics.collect('graph_triples', 'gauge', lambda: s.db.triples,
+                            help='triples in the in-memory comment graph')
+        if s.alerts is not None:
+            for name, type, key in [
+                ('alert_queue_depth', 'gauge', 'depth'),
+                ('alerts_delivered_total', 'counter', 'delivered'),
+                ('alerts_failed_total', 'counter', 'failed'),
+                ('alert_last_latency_seconds', 'gauge', 'lastLatency')]:
+                metrics.collect(name, type,
+                                lambda key=key: s.alerts.stats()[key])
+
+def openStore(spec, checkInterval=0, commitWindow=0):
+    """
+    'mongo', 'log[:dir]' or 'columnar[:dir]'. checkInterval is how
+    stale (in seconds) reads may be about changes from other processes.
+    mongo writes within commitWindow secs of each other share an insert
+    """
+    kind, _, path = spec.partition(':')
+    if kind == 'mongo':
+        return DbMongo(threaded=True, checkInterval=checkInterval,
+                       commitWindow=commitWindow)
+    if kind == 'log':
+        from logstore import DbLog
+        return DbLog(*filter(None, [path]), checkInterval=checkInterval)
+    if kind == 'columnar':
+        from columnstore import DbColumnar
+        return DbColumnar(*filter(None, [path]))
+    raise ValueError("unknown store %r" % spec)
+
+def watchAccessFile(db):
+    """
+    refresh as soon as access.n3 changes, instead of at the next
+    check. Needs linux inotify; elsewhere we just wait for the check
+    """
+    try:
+        from twisted.internet import inotify
+    except ImportError:
+        return None
+    from twisted.python.filepath import FilePath
+    path = FilePath(db.accessFile)
+    def changed(_, filepath, mask):
+        if filepath == path:
+            db.refresh()
+    notifier = inotify.INotify()
+    notifier.startReading()
+    # watch the dir, since editors often replace the file
+    notifier.watch(path.parent(), callbacks=[changed])
+    return notifier
 
 if __name__ == '__main__':
-    db = DbMongo()
-    from twisted.python.log import startLogging
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--store", default="mongo",
+                      help="mongo, log[:dir] or columnar[:dir]")
+    parser.add_option("--snapshot", default="snapshot.pickle",
+                      help="where the mongo store keeps its startup snapshot")
+    parser.add_option("--snapshot-minutes", type="float", default=10)
+    parser.add_option("--check-seconds", type="float", default=5,
+                      help="how often reads look for comments written "
+                      "by other processes")
+    parser.add_option("--public-cache-control", default="public, no-cache",
+                      help="Cache-Control for /public/ comments and counts. "
+                      "The default lets caches keep them but revalidate "
+                      "each time")
+    parser.add_option("--ip-posts-per-minute", type="float", default=2)
+    parser.add_option("--ip-burst", type="int", default=5,
+                      help="posts one ip can make at once before the "
+                      "per-minute rate applies")
+    parser.add_option("--post-comments-per-minute", type="float", default=6)
+    parser.add_option("--post-burst", type="int", default=20,
+                      help="comments one post can get at once before the "
+                      "per-minute rate applies")
+    parser.add_option("--commit-ms", type="float", default=10,
+                      help="comments posted this close together go to "
+                      "mongo in one insert")
+    parser.add_option("--port", type="int", default=9031)
+    parser.add_option("--workers", type="int", default=1,
+                      help="server processes sharing the port, each with "
+                      "its own copy of the comments. Needs --store=mongo")
+    parser.add_option("--peer-dir", default="/tmp/commentServe-peers",
+                      help="where workers keep their sockets for telling "
+                      "each other about writes")
+    parser.add_option("--listen-fd", type="int", help="(set for workers)")
+    parser.add_option("--worker-index", type="int", default=0,
+                      help="(set for workers)")
+    opts, args = parser.parse_args()
     import sys
+    if opts.workers > 1 and opts.listen_fd is None:
+        # the other stores aren't safe to share between processes
+        if opts.store != 'mongo':
+            parser.error("--workers needs --store=mongo")
+        from workers import runWorkers
+        runWorkers(opts.workers, opts.port, opts.peer_dir, sys.argv)
+        sys.exit()
+
+    db = openStore(opts.store, opts.check_seconds, opts.commit_ms / 1000)
+    # workers share the snapshot file, so only one writes it
+    if hasattr(db, 'saveSnapshot') and opts.worker_index == 0:
+        from twisted.internet.task import LoopingCall
+        db.loadSnapshot(opts.snapshot)
+        LoopingCall(db.saveSnapshot, opts.snapshot).start(
+            opts.snapshot_minutes * 60, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      db.saveSnapshot, opts.snapshot)
+    elif hasattr(db, 'loadSnapshot'):
+        db.loadSnapshot(opts.snapshot)
+    from twisted.python.log import startLogging
     startLogging(sys.stdout)
-    reactor.listenTCP(9031, Application(db))
+    honeypot = HoneypotChecker(open("priv-honeypotkey").read().strip())
+    peers = None
+    if opts.listen_fd is not None:
+        from workers import Peers
+        peers = Peers(opts.peer_dir, db)
+        peers.listen(reactor)
+    # each worker has its own buckets and gets about 1/workers of the
+    # posts, so split the limits between them
+    n = float(opts.workers)
+    app = Application(db, honeypot=honeypot, alerts=AlertQueue(),
+                      publicCacheControl=opts.public_cache_control,
+                      rateLimiter=RateLimiter(
+                          opts.ip_posts_per_minute / n,
+                          max(1, int(opts.ip_burst / n)),
+                          opts.post_comments_per_minute / n,
+                          max(1, int(opts.post_burst / n))),
+                      peers=peers)
+    def listen(_):
+        if opts.listen_fd is not None:
+            import socket
+            return reactor.adoptStreamPort(opts.listen_fd, socket.AF_INET,
+                                           app)
+        return reactor.listenTCP(opts.port, app)
+    # don't serve until we've caught up with what's in the store
+    ready = defer.succeed(None)
+    if hasattr(db, 'refresh'):
+        ready = db.refresh()
+        watchAccessFile(db)
+    ready.addCallback(listen)
     reactor.run()
@@ -10,3 +10,89 @@ class TestSpamCheck(unittest.TestCase):
     def testNoLinkAtTheEnd(self):
         self.assertRaises(ValueError, spamCheck, None, 'too many spammers were doing this http://dumbsite.com')
         
+
+import datetime
+from rdflib import URIRef
+from commentServe import streamComments, templateRows, toHttps
+
+class FakeTransport(object):
+    """a consumer that only sends its buffer when the test says so"""
+    def __init__(self):
+        self.unsent, self.sent = [], []
+        self.mostUnsent = 0
+        self.producer = None
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        producer.resumeProducing()
+    def unregisterProducer(self):
+        self.producer = None
+    def write(self, data):
+        self.unsent.append(data)
+        self.mostUnsent = max(self.mostUnsent, sum(map(len, self.unsent)))
+    def send(self):
+        self.sent.extend(self.unsent)
+        self.unsent = []
+        if self.producer is not None:
+            self.producer.resumeProducing()
+
+class TestStreamComments(unittest.TestCase):
+    def stream(self, n):
+        """returns the transport, the deferred, and how many rows were read"""
+        consumed = [0]
+        def rows():
+            for i in range(n):
+                consumed[0] += 1
+                yield (datetime.datetime(2013, 1, 1), u"someone",
+                       u"<p>comment number %s</p>" % i, str(i), None)
+        transport = FakeTransport()
+        d = streamComments(transport, transport.write, chunkBytes=4096,
+                           includeJs=False, public=True,
+                           parent=URIRef("http://example.com/post"),
+                           toHttps=toHttps, agoString=lambda t: "ago", you=None,
+                           rows=templateRows(rows()), olderUri=None, newerUri=None)
+        return transport, d, consumed
+
+    def testWaitsForTheTransportToSend(self):
+        transport, d, consumed = self.stream(5000)
+        self.assertEqual(len(transport.unsent), 1)
+        self.assertTrue(consumed[0] < 100)
+        self.assertFalse(d.called)
+        while transport.producer is not None:
+            transport.send()
+        transport.send()
+        self.assertTrue(transport.mostUnsent < 4096 + 1024)
+        self.assertTrue(u"comment number 4999" in u"".join(transport.sent))
+        finished = []
+        d.addCallback(finished.append)
+        self.assertEqual(finished, [True])
+
+    def testClientGoingAwayStopsRendering(self):
+        transport, d, consumed = self.stream(5000)
+        transport.producer.stopProducing()
+        read = consumed[0]
+        self.assertEqual(transport.producer, None)
+        transport.send()
+        self.assertEqual(consumed[0], read)
+        finished = []
+        d.addCallback(finished.append)
+        self.assertEqual(finished, [False])
+
+from dateutil.tz import tzutc
+from commentServe import agoBucket
+
+class TestAgoBucket(unittest.TestCase):
+    def setUp(self):
+        self.newest = datetime.datetime(2013, 1, 1, 12, 0, tzinfo=tzutc())
+        self.t = 1357041600 # self.newest
+
+    def testMinutesOldChangesEachMinute(self):
+        now = self.t + 10 * 60
+        self.assertEqual(agoBucket(self.newest, now),
+                         agoBucket(self.newest, now + 30))
+        self.assertNotEqual(agoBucket(self.newest, now),
+                            agoBucket(self.newest, now + 60))
+
+    def testOlderPagesChangeLessOften(self):
+        self.assertEqual(agoBucket(self.newest, self.t + 20)[0], 1)
+        self.assertEqual(agoBucket(self.newest, self.t + 5 * 3600)[0], 3600)
+        self.assertEqual(agoBucket(self.newest, self.t + 9 * 86400)[0], 86400)
@@ -1,10 +1,15 @@
-import time, glob, os, tempfile, logging, datetime
+import time, os, logging, datetime, bisect, cPickle, gc, hashlib
+from operator import itemgetter
 from dateutil.parser import parse
 from dateutil.tz import tzlocal
 import rdflib
-from rdflib.graph import ConjunctiveGraph
-from rdflib import Namespace
+from rdflib.graph import ConjunctiveGraph, Graph
+from rdflib import Namespace, URIRef, Literal, BNode, RDF
 from rdflib.parser import StringInputSource
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+from sanitize import sanitize_html, SANITIZER_VERSION
+import metrics
 
 log = logging.getLogger("db")
 
@@ -14,8 +19,304 @@ DCTERMS = Namespace("http://purl.org/dc/terms/")
 XS = Namespace("http://www.w3.org/2001/XMLSchema#")
 FOAF = Namespace("http://xmlns.com/foaf/0.1/")
 
+ACCESS_FILE = "/my/proj/openid_proxy/access.n3"
+ACCESS_CTX = URIRef("http://bigasterisk.com/openid_proxy/access")
+
+# bump when the pickled state in DbMongo.saveSnapshot changes shape
+SNAPSHOT_VERSION = 7
+
+def _termId(obj):
+    """
+    snapshot pickles store rdf terms like this, since rdflib's own
+    pickling revalidates every URI and reparses every literal
+    """
+    if type(obj) is URIRef:
+        return ('U', unicode(obj))
+    if type(obj) is Literal:
+        # an XMLLiteral's value is a minidom tree, and nothing here
+        # reads it
+        return ('L', unicode(obj), obj.language, obj.datatype,
+                None if obj.datatype == RDF.XMLLiteral else obj.value)
+    return None
+
+class _TermLoader(object):
+    """reverses _termId, sharing one object per uri"""
+    def __init__(self):
+        self.uris = {}
+
+    def __call__(self, pid):
+        if pid[0] == 'U':
+            try:
+                return self.uris[pid[1]]
+            except KeyError:
+                uri = self.uris[pid[1]] = unicode.__new__(URIRef, pid[1])
+                return uri
+        lit = unicode.__new__(Literal, pid[1])
+        lit._language, lit._datatype, lit._value = pid[2:]
+        return lit
+
+def docContext(docId):
+    """graph context holding the triples of one mongo comment doc"""
+    return URIRef("http://bigasterisk.com/comment/doc/%s" % docId)
+
 initNs = dict(sioc=SIOC, content=CONTENT, foaf=FOAF, dcterms=DCTERMS, xs=XS)
 
+class CommentIndex(object):
+    """
+    the non-spam comments on each parent, and by each creator, kept
+    sorted by created time. Each row is (created, creatorName, html,
+    docId, creator), where html is the sanitized content.
+
+    digests has an xor of the docDigests of each parent's rows, which
+    changes with any comment added or removed, and comes out the same
+    in every process that has the same comments.
+    """
+    def __init__(self):
+        self.byParent = {} # parent : [row, ...]
+        self.byCreator = {} # creator : [row, ...]
+        self.byDoc = {} # docId : (parent, row)
+        self.digests = {} # parent : int
+
+    def add(self, parent, row):
+        docId = row[3]
+        if docId in self.byDoc:
+            self.remove(docId)
+        bisect.insort(self.byParent.setdefault(parent, []), row)
+        bisect.insort(self.byCreator.setdefault(row[4], []), row)
+        self.byDoc[docId] = (parent, row)
+        self._changed(parent, docId)
+
+    def remove(self, docId):
+        """returns the parent the doc was on, or None"""
+        try:
+            parent, row = self.byDoc.pop(docId)
+        except KeyError:
+            return None
+        rows = self.byParent[parent]
+        rows.remove(row)
+        if not rows:
+            del self.byParent[parent]
+        # a prolific user's list is long, so find the row by bisecting
+        rows = self.byCreator[row[4]]
+        del rows[bisect.bisect_left(rows, row)]
+        if not rows:
+            del self.byCreator[row[4]]
+        self._changed(parent, docId)
+        return parent
+
+    def _changed(self, parent, docId):
+        digest = self.digests.get(parent, 0) ^ docDigest(docId)
+        if digest:
+            self.digests[parent] = digest
+        else:
+            self.digests.pop(parent, None)
+
+    def version(self, parent):
+        """(newest created, count, digest) of this parent's rows"""
+        rows = self.byParent.get(parent, [])
+        return (rows[-1][0] if rows else None, len(rows),
+                self.digests.get(parent, 0))
+
+    def rows(self, parent):
+        return self.byParent.get(parent, [])
+
+    def count(self, parent):
+        return len(self.byParent.get(parent, ()))
+
+    def copy(self):
+        """one that later changes to us won't affect (rows are tuples)"""
+        other = CommentIndex()
+        other.byParent = dict((k, list(v)) for k, v in self.byParent.iteritems())
+        other.byCreator = dict((k, list(v))
+                               for k, v in self.byCreator.iteritems())
+        other.byDoc = dict(self.byDoc)
+        other.digests = dict(self.digests)
+        return other
+
+    def byUser(self, creator, limit=None, before=None, after=None):
+        """
+        (created, creatorName, html, docId, creator, parent) for this
+        creator's comments, newest first; paging as in page()
+        """
+        rows = page(self.byCreator.get(creator, []), itemgetter(0), limit,
+                    before, after)
+        return [row + (self.byDoc[row[3]][0],) for row in reversed(rows)]
+
+    def refreshNames(self, nameOf):
+        """nameOf(creator) -> current foaf name; for when access.n3 changes"""
+        for parent, rows in self.byParent.items():
+            rows[:] = [(r[0], nameOf(r[4]), r[2], r[3], r[4]) for r in rows]
+            for r in rows:
+                self.byDoc[r[3]] = (parent, r)
+        for creator, rows in self.byCreator.items():
+            rows[:] = [self.byDoc[r[3]][1] for r in rows]
+
+def docDigest(docId):
+    """a hash of a docId that's the same in every process"""
+    return int(hashlib.md5(docId).hexdigest()[:16], 16)
+
+class _Keys(object):
+    """key(row) for each of rows, as a sequence bisect can search"""
+    def __init__(self, rows, key):
+        self.rows, self.key = rows, key
+    def __len__(self):
+        return len(self.rows)
+    def __getitem__(self, i):
+        return self.key(self.rows[i])
+
+def page(rows, key, limit=None, before=None, after=None, keep=None):
+    """
+    rows (sorted by key(row), e.g. created time) strictly between after
+    and before, and for which keep(row) if given. With a limit, that's
+    the first limit of them if you only gave 'after' (paging forward),
+    otherwise the last limit of them
+    """
+    keys = _Keys(rows, key)
+    lo = 0 if after is None else bisect.bisect_right(keys, after)
+    hi = len(rows) if before is None else bisect.bisect_left(keys, before)
+    rows = rows[lo:hi]
+    if keep is not None:
+        rows = filter(keep, rows)
+    if limit is not None:
+        if after is not None and before is None:
+            rows = rows[:limit]
+        else:
+            rows = rows[max(0, len(rows) - limit):]
+    return rows
+
+def termFields(term):
+    """an rdf term as a list that json and mongo can store"""
+    if isinstance(term, URIRef):
+        return ['u', unicode(term)]
+    if isinstance(term, Literal):
+        return ['l', unicode(term),
+                term.datatype and unicode(term.datatype), term.language]
+    return ['b', unicode(term)]
+
+def termFromFields(fields):
+    if fields[0] == 'u':
+        return URIRef(fields[1])
+    if fields[0] == 'l':
+        return Literal(fields[1], datatype=fields[2], lang=fields[3])
+    return BNode(fields[1])
+
+def parseDoc(doc):
+    """
+    graph of the triples in one mongo comment doc. Docs from before
+    commentDoc stored 'triples' have only their n3
+    """
+    g = Graph()
+    if 'triples' in doc:
+        for t in doc['triples']:
+            g.add((termFromFields(t[0]), termFromFields(t[1]),
+                   termFromFields(t[2])))
+        return g
+    g.parse(StringInputSource(doc['n3'].encode('utf8')), format="n3")
+    return g
+
+def docN3(doc):
+    """the n3 of one comment doc, made from its triples if need be"""
+    if 'triples' not in doc:
+        return doc['n3']
+    return u"".join(u"%s %s %s .\n" % tuple(termFromFields(f).n3() for f in t)
+                    for t in doc['triples'])
+
+def docHtml(doc, docGraph):
+    """
+    the sanitized content of one comment doc: the stored html, if it's
+    from the current sanitizer, or else a fresh sanitize of its triples
+    """
+    if doc.get('sanitizerVersion') == SANITIZER_VERSION:
+        return doc['html']
+    for content in docGraph.objects(None, CONTENT.encoded):
+        return sanitize_html(content)
+    return None
+
+def indexRows(graph, ctx, docId, html):
+    """
+    (parent, row) for each comment in ctx, a graph of one doc, with the row
+    shaped for CommentIndex. Names are looked up in the whole graph,
+    since logged-in users' names come from access.n3. html is the
+    doc's sanitized content, from docHtml.
+    """
+    for parent, _, comment in ctx.triples((None, SIOC.has_reply, None)):
+        created = ctx.value(comment, DCTERMS.created)
+        content = ctx.value(comment, CONTENT.encoded)
+        creator = ctx.value(comment, SIOC.has_creator)
+        if created is None or content is None or creator is None:
+            continue
+        yield parent, (parse(created), graph.value(creator, FOAF.name),
+                       html, docId, creator)
+
+def docFields(g):
+    """
+    the fields of one comment we store outside its n3, so listings
+    don't have to parse it. g is the graph of one comment doc
+    """
+    for parent, _, uri in g.triples((None, SIOC.has_reply, None)):
+        return dict(uri=uri,
+                    creator=g.value(uri, SIOC.has_creator),
+                    content=g.value(uri, CONTENT.encoded))
+    return {}
+
+def commentDoc(stmts, ctx, html=None):
+    """
+    the stored form of one comment: its statements as 'triples' of
+    termFields (see docN3 for them as n3), plus some fields pulled out
+    for querying and listing. html is the sanitized comment content, if
+    you have it.
+
+    This doesn't go through an rdflib graph, which used to be most of
+    the cost of a write.
+    """
+    doc = {'ctx' : ctx}
+    if html is not None:
+        doc['html'] = html
+        doc['sanitizerVersion'] = SANITIZER_VERSION
+
+    triples, seen, objects = [], set(), {}
+    for s in stmts:
+        if s in seen:
+            continue
+        seen.add(s)
+        triples.append([termFields(t) for t in s])
+        objects.setdefault((s[0], s[1]), s[2])
+        if s[1] == SIOC.has_reply:
+            doc['topic'] = s[0]
+            doc['uri'] = s[2]
+        if s[1] == DCTERMS.created: # expecting 2 of these, but same value
+            doc['created'] = parse(s[2])
+
+    # as docFields would find them
+    if 'uri' in doc:
+        doc['creator'] = objects.get((doc['uri'], SIOC.has_creator))
+        doc['content'] = objects.get((doc['uri'], CONTENT.encoded))
+    doc['triples'] = triples
+    return doc
+
+def recentCommentRow(doc):
+    """the fields index.mustache shows for a comment doc"""
+    if 'uri' in doc:
+        return dict(
+            parent=URIRef(doc['topic']),
+            uri=URIRef(doc['uri']),
+            created=doc['created'].isoformat(),
+            content=doc['content'],
+            creator=doc['creator'] and URIRef(doc['creator']),
+            docId=str(doc['_id']),
+            isSpam=doc.get('type', ''))
+    # stored before docFields; backfill.py adds the fields
+    g = parseDoc(doc)
+    parent, _, uri = g.triples((None, SIOC.has_reply, None)).next()
+    return dict(
+        parent=parent,
+        uri=uri,
+        created=g.value(uri, DCTERMS.created),
+        content=g.value(uri, CONTENT.encoded),
+        creator=g.value(uri, SIOC.has_creator),
+        docId=str(doc['_id']),
+        isSpam=doc.get('type', ''))
+
 class _shared(object):
     def query(self, *args, **kw):
         kw['initNs'] = initNs
@@ -24,109 +325,694 @@ class _shared(object):
     def value(self, *args, **kw):
         return self.getGraph().value(*args, **kw)
 
-class Db(_shared):
-    def __init__(self):
-        self.lastTimes = []
+    def getCommentsForParent(self, parent, limit=None, before=None,
+                             after=None):
+        """
+        [(created, creatorName, html, docId, creator), ...] in
+        created order. docId is None when the store doesn't have them.
 
-    def getGraph(self):
-        t1 = time.time()
+        before and after are datetimes, for paging; see page()
+        """
+        rows = [(parse(when), who, sanitize_html(content), None, cr)
+                for who, when, content, cr in self.query("""
+               SELECT DISTINCT ?who ?when ?content ?cr WHERE {
+                 ?parent sioc:has_reply [
+                   sioc:has_creator ?cr;
+                   content:encoded ?content;
+                   dcterms:created ?when
+                   ]
+                 OPTIONAL { ?cr foaf:name ?who }
+               } ORDER BY ?when""", initBindings={"parent" : parent})]
+        return page(rows, itemgetter(0), limit, before, after)
+
+    def getCommentsByUser(self, user, limit=None, before=None, after=None):
+        """
+        [(created, creatorName, html, docId, creator, parent), ...] for
+        this user's comments, newest first. Paging is by created time,
+        as in getCommentsForParent
+        """
+        rows = [(parse(when), who, sanitize_html(content), None, user, parent)
+                for parent, who, when, content in self.query("""
+               SELECT DISTINCT ?parent ?who ?when ?content WHERE {
+                 ?parent sioc:has_reply [
+                   sioc:has_creator ?cr;
+                   content:encoded ?content;
+                   dcterms:created ?when
+                   ]
+                 OPTIONAL { ?cr foaf:name ?who }
+               } ORDER BY ?when""", initBindings={"cr" : user})]
+        return list(reversed(page(rows, itemgetter(0), limit, before, after)))
 
-        mtimes = []
-        for f in (["/my/proj/openid_proxy/access.n3"] +
-                  glob.glob("commentstore/*.nt")):
-            mtimes.append(os.path.getmtime(f))
+    def getCommentCount(self, parent):
+        return len(list(self.query("""
+               SELECT DISTINCT ?r WHERE {
+                 ?parent sioc:has_reply ?r
+               }""", initBindings={"parent" : parent})))
 
-        if mtimes == self.lastTimes and hasattr(self, 'currentGraph'):
-            return self.currentGraph
-        self.lastTimes = mtimes
+    def getCommentCounts(self, parents):
+        """{parent : count} for all of these parents"""
+        return dict((p, self.getCommentCount(p)) for p in parents)
+
+    def getCommentVersion(self, parent):
+        """
+        a string that changes whenever what we'd return for this
+        parent does, or None if this store can't tell cheaply
+        """
+        return None
+
+    def getNewestCommentTime(self, parents):
+        """created time of the newest comment on any of these parents, or None"""
+        times = [rows[-1][0] for rows in map(self.getCommentsForParent, parents)
+                 if rows]
+        return max(times) if times else None
+
+class _indexed(_shared):
+    """
+    keeps the triples of every non-spam comment doc in currentGraph,
+    one context per doc, plus a CommentIndex of them. Subclasses
+    implement _newDocs and use _addDoc and _removeDoc for their own
+    changes.
+
+    With threaded=True, reads never wait on I/O: they answer from what
+    we have and start a refresh(), which fetches and parses in a
+    thread and then applies the changes on the reactor thread.
+    Otherwise reads sync() first, blocking.
+
+    Reads look for other processes' changes at most once every
+    checkInterval seconds; in between they do no I/O at all.
+    """
+    threaded = False
+    checkInterval = 0
+    clock = time.time
 
-        tf = tempfile.NamedTemporaryFile()
-        os.system("cat /my/proj/openid_proxy/access.n3 commentstore/*.nt > %s" % tf.name)
+    def _reset(self):
         self.currentGraph = ConjunctiveGraph()
-        self.currentGraph.parse(tf.name, format="n3")
-      
-        log.info("reloaded comments from disk in %f sec" % (time.time() - t1))
+        self.index = CommentIndex()
+        self.docIds = set() # docs whose triples are in currentGraph
+        self.triples = 0 # len(currentGraph), which would be a scan
+        self.lastCreated = None # newest 'created' we've synced
+        # newest 'typeChanged' we've synced. What changed before we
+        # started, the first sync gets anyway
+        self.lastTypeChange = datetime.datetime.now(tzlocal())
+        self.accessGraph = Graph() # what we last loaded from access.n3
+        self.accessMtime = None
+        self.refreshWaiters = None # deferreds for the refresh in progress
+        self.queuedWaiters = [] # deferreds for the one after it
+        self.onParentChanged = [] # funcs of parent, for cache invalidation
+        self.lastCheck = None # clock() when a read last looked for changes
 
+    def getGraph(self):
+        self._freshen()
         return self.currentGraph
-        
-    def writeFile(self, stmts, ctx, fileWords):
-        outfile = "commentstore/post-%s.nt" % ("-".join(fileWords))
-        graph = ConjunctiveGraph()
-
-        graph.add(*stmts, **{'context' : ctx})
-        graph.graph.serialize(outfile, format='n3')
-        log.info("wrote new comment to %s", outfile)
-        # this could be optimized to add to currentGraph and reload
-        # less often, but i'm currently at 600ms for a reload
-
-class DbMongo(_shared):
-    def __init__(self):
-        from pymongo import Connection
-        self.mongo = Connection('bang', 27017, tz_aware=True)['comment']
+
+    def getCommentsForParent(self, parent, limit=None, before=None,
+                             after=None):
+        self._freshen()
+        rows = self.index.rows(parent)
+        if limit is None and before is None and after is None:
+            # a copy, since a stream=1 render goes on over many reactor
+            # turns while we add and remove rows
+            return list(rows)
+        return page(rows, itemgetter(0), limit, before, after)
+
+    def getCommentsByUser(self, user, limit=None, before=None, after=None):
+        self._freshen()
+        return self.index.byUser(user, limit, before, after)
+
+    def getCommentCount(self, parent):
+        self._freshen()
+        return self.index.count(parent)
+
+    def getCommentCounts(self, parents):
+        self._freshen()
+        return dict((p, self.index.count(p)) for p in parents)
+
+    def getCommentVersion(self, parent):
+        """
+        a string that changes whenever what we'd return for this parent
+        does, for Etags. Includes access.n3's mtime, since that has the
+        names. It's made only from what's stored, so other --workers
+        with the same comments give the same Etags
+        """
+        self._freshen()
+        return "%s-%s-%s-%x" % ((self.accessMtime,) +
+                                self.index.version(parent))
+
+    def getNewestCommentTime(self, parents):
+        self._freshen()
+        times = [rows[-1][0] for rows in map(self.index.rows, parents) if rows]
+        return max(times) if times else None
+
+    def _freshen(self):
+        now = self.clock()
+        if (self.lastCheck is not None and
+            now - self.lastCheck < self.checkInterval):
+            return
+        self.lastCheck = now
+        if self.threaded:
+            self.refresh()
+        else:
+            self.sync()
+
+    def sync(self):
+        """bring us up to date, blocking"""
+        with metrics.timed('graph_update_seconds', kind='sync'):
+            self._applyChanges(self._fetchChanges(
+                self.lastCreated, self.lastTypeChange, self.accessMtime))
+
+    def refresh(self):
+        """
+        bring us up to date in a thread. The returned deferred fires
+        when a refresh that started after this call is done. Only one
+        refresh runs at a time; calls during one share a single
+        refresh after it, since the running one may have already
+        missed what they're asking about.
+        """
+        d = defer.Deferred()
+        if self.refreshWaiters is not None:
+            self.queuedWaiters.append(d)
+            return d
+        self._startRefresh([d])
+        return d
+
+    def _startRefresh(self, waiters):
+        self.refreshWaiters = waiters
+        t1 = time.time()
+        fetch = threads.deferToThread(self._fetchChanges, self.lastCreated,
+                                      self.lastTypeChange, self.accessMtime)
+        fetch.addCallback(self._applyChanges)
+        def done(result):
+            metrics.observe('graph_update_seconds', time.time() - t1,
+                            kind='refresh')
+            if isinstance(result, Failure):
+                log.error("refresh failed: %s" % result.getTraceback())
+            elif result:
+                log.info("refresh added %s comments in %f sec" %
+                         (result, time.time() - t1))
+            waiters, self.refreshWaiters = self.refreshWaiters, None
+            if self.queuedWaiters:
+                queued, self.queuedWaiters = self.queuedWaiters, []
+                self._startRefresh(queued)
+            for w in waiters:
+                w.callback(None)
+        fetch.addBoth(done)
+
+    def _newDocs(self, lastCreated):
+        """
+        (docs, newest): the non-spam docs created at or after
+        lastCreated that we don't have yet, oldest first, and the
+        newest 'created' the query saw, counting the docs we already
+        had. May be called in a thread.
+        """
+        return [], lastCreated
+
+    def _typeChanges(self, lastTypeChange):
+        """
+        (docs, newest): the docs whose type changed at or after
+        lastTypeChange, and the newest 'typeChanged' the query saw.
+        May be called in a thread.
+        """
+        return [], lastTypeChange
+
+    def _fetchChanges(self, lastCreated, lastTypeChange, accessMtime):
+        """
+        the I/O and parsing half of a sync, safe to run in a thread
+        since it doesn't touch our state. Returns (new access graph or
+        None, its mtime, [(doc, docGraph, html), ...], new lastCreated,
+        [type changed doc, ...], new lastTypeChange)
+        """
+        accessGraph = None
+        mtime = os.path.getmtime(self.accessFile)
+        if mtime != accessMtime:
+            accessGraph = Graph()
+            accessGraph.parse(self.accessFile, format="n3")
+        docs, lastCreated = self._newDocs(lastCreated)
+        docs = [(doc, parseDoc(doc)) for doc in docs]
+        # after the new docs, so a type change to one of them is seen
+        typeDocs, lastTypeChange = self._typeChanges(lastTypeChange)
+        return (accessGraph, mtime, [(doc, g, docHtml(doc, g))
+                                     for doc, g in docs], lastCreated,
+                typeDocs, lastTypeChange)
+
+    def _applyChanges(self, changes):
+        """
+        the other half of a sync, which has to run on the reactor
+        thread. Returns how many docs were added
+        """
+        (accessGraph, mtime, docs, lastCreated,
+         typeDocs, lastTypeChange) = changes
+        if accessGraph is not None:
+            self._setAccess(accessGraph, mtime)
+        added = 0
+        for doc, docGraph, html in docs:
+            if self._addDoc(doc, docGraph, html):
+                added += 1
+        for doc in typeDocs: # as they are now; we may have some already
+            if doc.get('type') == 'spam':
+                self._removeDoc(doc)
+            else:
+                self._addDoc(doc)
+        # only what a sync saw counts, not our own writes, which could
+        # be newer than another process's that we haven't seen yet
+        if lastCreated is not None and (self.lastCreated is None or
+                                        lastCreated > self.lastCreated):
+            self.lastCreated = lastCreated
+        self.lastTypeChange = max(self.lastTypeChange, lastTypeChange)
+        return added
+
+    def _setAccess(self, accessGraph, mtime):
+        ctx = self.currentGraph.get_context(ACCESS_CTX)
+        for triple in self.accessGraph:
+            ctx.remove(triple)
+        self.triples += len(accessGraph) - len(self.accessGraph)
+        self.accessGraph = accessGraph
+        self.currentGraph.addN((s, p, o, ctx)
+                               for s, p, o in self.accessGraph)
+        self.accessMtime = mtime
+        self.index.refreshNames(
+            lambda cr: self.currentGraph.value(cr, FOAF.name))
+        for parent in self.index.byParent.keys():
+            self._parentChanged(parent)
+
+    def _parentChanged(self, parent):
+        for f in self.onParentChanged:
+            f(parent)
+
+    def _addDoc(self, doc, docGraph=None, html=None):
+        """docGraph and html are from parseDoc and docHtml, if you have them"""
+        docId = str(doc['_id'])
+        if docId in self.docIds:
+            return False
+        # parsing straight into currentGraph would cost a scan of
+        # the whole store (rdflib clears the context first), so we
+        # parse into a scratch graph and add its triples
+        if docGraph is None:
+            docGraph = parseDoc(doc)
+            html = docHtml(doc, docGraph)
+        ctx = self.currentGraph.get_context(docContext(docId))
+        self.currentGraph.addN((s, p, o, ctx) for s, p, o in docGraph)
+        self.triples += len(docGraph)
+        for parent, row in indexRows(self.currentGraph, docGraph, docId,
+                                     html):
+            self.index.add(parent, row)
+            self._parentChanged(parent)
+        self.docIds.add(docId)
+        return True
+
+    def _removeDoc(self, doc):
+        """returns the parent the doc was on, if it was indexed"""
+        docId = str(doc['_id'])
+        if docId not in self.docIds:
+            return None
+        ctx = self.currentGraph.get_context(docContext(docId))
+        docGraph = parseDoc(doc)
+        for triple in docGraph:
+            ctx.remove(triple)
+        self.triples -= len(docGraph)
+        self.docIds.discard(docId)
+        parent = self.index.remove(docId)
+        if parent is not None:
+            self._parentChanged(parent)
+        return parent
+
+class DbMongo(_indexed):
+    # created is stamped before the insert (and group commit holds it
+    # a bit longer), so another process's comment can land after we've
+    # synced newer ones. Each sync looks this far back again, and the
+    # same for typeChanged, which setType stamps
+    syncOverlap = datetime.timedelta(seconds=60)
+
+    def __init__(self, mongo=None, accessFile=ACCESS_FILE, incremental=True,
+                 threaded=False, checkInterval=0, commitWindow=0,
+                 maxBatch=100):
+        """
+        mongo is a pymongo Database (default is the 'comment' db on
+        bang). With incremental=False, every change rebuilds the whole
+        graph like we used to.
+
+        With threaded=True (for running under the reactor), mongo
+        calls happen in threads, and writeFile, setType and
+        getRecentComments return deferreds. Then writeFile calls within
+        commitWindow secs of the first one go to mongo in one insert,
+        or as soon as there are maxBatch of them.
+
+        Reads look for comments written by other processes, and for
+        type changes like spam markings, at most every checkInterval
+        seconds.
+        """
+        if mongo is None:
+            from pymongo import Connection
+            mongo = Connection('bang', 27017, tz_aware=True)['comment']
+        self.mongo = mongo
+        self.accessFile = accessFile
+        self.incremental = incremental
+        self.threaded = threaded
+        self.checkInterval = checkInterval
+        self.commitWindow = commitWindow
+        self.maxBatch = maxBatch
+        self.pendingWrites = [] # (doc, deferred) for the next insert
+        self.commitCall = None
+        self.snapshotLock = defer.DeferredLock()
 
         self.lastTime = 0
         self.notSpam = {"type":{"$ne":"spam"}}
+        self._reset()
+        self.mongo['comment'].ensure_index('created')
+        self.mongo['comment'].ensure_index('typeChanged')
 
     def getGraph(self):
+        if not self.incremental:
+            return self._getGraphFull()
+        return _indexed.getGraph(self)
+
+    def getCommentsForParent(self, parent, **paging):
+        if not self.incremental:
+            return _shared.getCommentsForParent(self, parent, **paging)
+        return _indexed.getCommentsForParent(self, parent, **paging)
+
+    def getCommentsByUser(self, user, **paging):
+        if not self.incremental:
+            return _shared.getCommentsByUser(self, user, **paging)
+        return _indexed.getCommentsByUser(self, user, **paging)
+
+    def getCommentCount(self, parent):
+        if not self.incremental:
+            return _shared.getCommentCount(self, parent)
+        return _indexed.getCommentCount(self, parent)
+
+    def getCommentCounts(self, parents):
+        if not self.incremental:
+            return _shared.getCommentCounts(self, parents)
+        return _indexed.getCommentCounts(self, parents)
 
-        newDoc = self.mongo['comment'].find_one(self.notSpam,
-                                                sort=[('created', -1)])
+    def getCommentVersion(self, parent):
+        if not self.incremental:
+            return _shared.getCommentVersion(self, parent)
+        return _indexed.getCommentVersion(self, parent)
+
+    def getNewestCommentTime(self, parents):
+        if not self.incremental:
+            return _shared.getNewestCommentTime(self, parents)
+        return _indexed.getNewestCommentTime(self, parents)
+
+    def _getGraphFull(self):
+        newDoc = self._mongo('find_one', self.notSpam, sort=[('created', -1)])
         newDocTime = time.mktime(newDoc['created'].astimezone(tzlocal()).timetuple()) if newDoc is not None else 0
 
-        mtime = os.path.getmtime("/my/proj/openid_proxy/access.n3")
+        mtime = os.path.getmtime(self.accessFile)
 
         if newDocTime > self.lastTime or mtime > self.lastTime:
+            t1 = time.time()
             g = ConjunctiveGraph()
-            g.parse("/my/proj/openid_proxy/access.n3", format="n3")
+            g.parse(self.accessFile, format="n3")
             for doc in self.mongo['comment'].find(self.notSpam):
-                g.parse(StringInputSource(doc['n3'].encode('utf8')),
+                g.parse(StringInputSource(docN3(doc).encode('utf8')),
                         format="n3")
 
             self.currentGraph = g
+            self.triples = len(g)
             self.lastTime = max(newDocTime, mtime)
+            metrics.observe('graph_update_seconds', time.time() - t1,
+                            kind='full')
         return self.currentGraph
-        
-    def writeFile(self, stmts, ctx, fileWords):
-        g = ConjunctiveGraph()
-        doc = {'ctx' : ctx}
 
-        for s in stmts:
-            g.add(s)
-            if s[1] == SIOC.has_reply:
-                doc['topic'] = s[0]
-            if s[1] == DCTERMS.created: # expecting 2 of these, but same value
-                doc['created'] = parse(s[2])
+    def _newDocs(self, lastCreated):
+        spec = dict(self.notSpam)
+        if lastCreated is not None:
+            spec['created'] = {'$gte' : lastCreated - self.syncOverlap}
+        docs = self._mongo('find', spec, sort=[('created', 1)])
+        if docs:
+            # the ones we have count too, or with a single writer
+            # (whose writes are all known) this would never move
+            lastCreated = docs[-1]['created']
+        # (a membership test is safe while the reactor thread adds ids;
+        # _addDoc would skip these anyway, but this saves parsing them)
+        return [doc for doc in docs
+                if str(doc['_id']) not in self.docIds], lastCreated
+
+    def _typeChanges(self, lastTypeChange):
+        spec = {'typeChanged' : {'$gte' : lastTypeChange - self.syncOverlap}}
+        docs = self._mongo('find', spec, sort=[('typeChanged', 1)])
+        if docs:
+            lastTypeChange = docs[-1]['typeChanged']
+        return docs, lastTypeChange
+
+    def saveSnapshot(self, path):
+        """
+        write our in-memory state, so a restart can load it and then
+        sync only what changed since.
+
+        The graph goes in as a list of its quads, which is much quicker
+        to take than pickling the graph itself. Taking that and copying
+        the index is all that happens on this thread; with
+        threaded=True, the pickling and writing happen in a thread and
+        this returns a deferred. That's still about 0.03 sec of
+        blocking per 1000 comments, and the pickling competes with the
+        reactor for the GIL while it runs
+        """
+        t1 = time.time()
+        gc.disable() # as in loadSnapshot
+        try:
+            state = dict(
+                version=(SNAPSHOT_VERSION, SANITIZER_VERSION),
+                quads=[(s, p, o, ctx.identifier) for s, p, o, ctx in
+                       self.currentGraph.quads((None, None, None))],
+                index=self.index.copy(), docIds=set(self.docIds),
+                triples=self.triples, lastCreated=self.lastCreated,
+                lastTypeChange=self.lastTypeChange,
+                # _setAccess replaces this graph instead of changing it
+                accessGraph=self.accessGraph, accessMtime=self.accessMtime)
+        finally:
+            gc.enable()
+        blocked = time.time() - t1
+
+        def write():
+            with open(path + ".tmp", "wb") as f:
+                pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = _termId
+                pickler.dump(state)
+            os.rename(path + ".tmp", path)
+        def done(_):
+            log.info("wrote snapshot of %s comments to %s in %f sec "
+                     "(%f sec blocking)" % (len(state['docIds']), path,
+                                            time.time() - t1, blocked))
+        if self.threaded:
+            # one at a time, so an older state can't land last
+            d = self.snapshotLock.run(threads.deferToThread, write)
+            return d.addCallback(done)
+        write()
+        done(None)
+
+    def loadSnapshot(self, path):
+        """returns False if there was no usable snapshot at path"""
+        t1 = time.time()
+        try:
+            with open(path, "rb") as f:
+                unpickler = cPickle.Unpickler(f)
+                unpickler.persistent_load = _TermLoader()
+                gc.disable() # it keeps rescanning all the new containers
+                try:
+                    state = unpickler.load()
+                finally:
+                    gc.enable()
+        except (IOError, EOFError, cPickle.UnpicklingError), e:
+            log.warn("not using snapshot %s: %s" % (path, e))
+            return False
+        if state['version'] != (SNAPSHOT_VERSION, SANITIZER_VERSION):
+            log.warn("not using snapshot %s from another version" % path)
+            return False
+        self.currentGraph = ConjunctiveGraph()
+        contexts = {}
+        def quads():
+            for s, p, o, ctxId in state['quads']:
+                ctx = contexts.get(ctxId)
+                if ctx is None:
+                    ctx = contexts[ctxId] = self.currentGraph.get_context(ctxId)
+                yield s, p, o, ctx
+        self.currentGraph.addN(quads())
+        self.index = state['index']
+        self.docIds = state['docIds']
+        self.triples = state['triples']
+        self.lastCreated = state['lastCreated']
+        self.lastTypeChange = state['lastTypeChange']
+        self.accessGraph = state['accessGraph']
+        self.accessMtime = state['accessMtime']
+        log.info("loaded snapshot of %s comments from %s in %f sec" %
+                 (len(self.docIds), path, time.time() - t1))
+        return True
+
+    def _mongo(self, op, *args, **kw):
+        """
+        self.mongo['comment'].<op>(*args, **kw), timed for /metrics.
+        A find's cursor is read into a list, so that's timed too
+        """
+        with metrics.stage('mongo', op=op):
+            ret = getattr(self.mongo['comment'], op)(*args, **kw)
+            if op == 'find':
+                ret = list(ret)
+        return ret
+
+    def _inThread(self, func, *args):
+        """
+        func(*args), or with threaded=True, a deferred for running it
+        in a thread. Chain the rest of the work, which may touch our
+        state, with _then.
+        """
+        if self.threaded:
+            return threads.deferToThread(func, *args)
+        return func(*args)
+
+    def _then(self, result, func):
+        if isinstance(result, defer.Deferred):
+            return result.addCallback(func)
+        return func(result)
+
+    def writeFile(self, stmts, ctx, fileWords, html=None):
+        """html is the sanitized comment content, if you have it"""
+        doc = commentDoc(stmts, ctx, html)
+        if self.threaded and self.commitWindow:
+            return self._queueWrite(doc)
+        return self._then(
+            self._inThread(lambda: self._mongo('insert', doc, safe=True)),
+            lambda _: self._inserted([doc]))
+
+    def _inserted(self, docs):
+        if self.incremental:
+            for doc in docs:
+                self._addDoc(doc)
 
-        doc['n3'] = g.serialize(format="n3")
-        self.mongo['comment'].insert(doc, safe=True)
+    def _queueWrite(self, doc):
+        d = defer.Deferred()
+        self.pendingWrites.append((doc, d))
+        if len(self.pendingWrites) >= self.maxBatch:
+            self._commit()
+        elif self.commitCall is None:
+            from twisted.internet import reactor
+            self.commitCall = reactor.callLater(self.commitWindow,
+                                                self._commit)
+        return d
+
+    def _commit(self):
+        """one insert for all the queued writes"""
+        if self.commitCall is not None and self.commitCall.active():
+            self.commitCall.cancel()
+        self.commitCall = None
+        batch, self.pendingWrites = self.pendingWrites, []
+        docs = [doc for doc, d in batch]
+        metrics.count('group_commits_total')
+        metrics.count('group_committed_comments_total', len(docs))
+        write = self._inThread(
+            lambda: self._mongo('insert', docs, safe=True))
+        def done(result):
+            if not isinstance(result, Failure):
+                self._inserted(docs)
+            for doc, d in batch:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(None)
+        write.addBoth(done)
+
+    def importComments(self, comments, batchSize=1000, progress=None):
+        """
+        store many comments, batchSize docs per insert. comments yields
+        (stmts, ctx) for each. Their html is sanitized here, so the
+        server won't have to.
+
+        This doesn't load them into memory, and a running server won't
+        sync ones older than what it already has; it's for filling a
+        db before serving it, like initmongo.py does. progress(n) is
+        called after each insert with the count so far. Returns the
+        count.
+        """
+        done, batch = 0, []
+        for stmts, ctx in comments:
+            html = None
+            for s in stmts:
+                if s[1] == CONTENT.encoded:
+                    html = sanitize_html(s[2])
+            batch.append(commentDoc(stmts, ctx, html))
+            if len(batch) >= batchSize:
+                self._mongo('insert', batch, safe=True)
+                done += len(batch)
+                batch = []
+                if progress:
+                    progress(done)
+        if batch:
+            self._mongo('insert', batch, safe=True)
+            done += len(batch)
+            if progress:
+                progress(done)
+        return done
 
     def getRecentComments(self, n=10, notOlderThan=None, withSpam=False):
-        self.mongo['comment'].ensure_index('created')
+        return self._inThread(self._getRecentComments, n, notOlderThan,
+                              withSpam)
+
+    def _getRecentComments(self, n, notOlderThan, withSpam):
         spec = {}
         if not withSpam:
-            spec = self.notSpam
+            spec = dict(self.notSpam)
         if notOlderThan is not None:
             now = datetime.datetime.now(tzlocal())
             spec['created'] = {
                 '$gt' : now - datetime.timedelta(days=notOlderThan)}
-        for doc in self.mongo['comment'].find(spec, limit=n,
-                                              sort=[('created', -1)]):
-            g = ConjunctiveGraph()
-            g.parse(StringInputSource(doc['n3'].encode('utf8')), format='n3')
-            parent, _, uri = g.triples((None, SIOC.has_reply, None)).next()
-            created = g.value(uri, DCTERMS.created)
-            content = g.value(uri, CONTENT.encoded)
-            creator = g.value(uri, SIOC.has_creator)
-            docId = str(doc['_id'])
-            isSpam = doc.get('type', '')
-            yield vars()
+        return [recentCommentRow(doc) for doc in
+                self._mongo('find', spec, limit=n, sort=[('created', -1)])]
 
     def setType(self, docId, type):
+        """returns the parent of the comment, if we know it"""
+        return self._then(self._inThread(self._setType, docId, type),
+                          lambda doc: self._typeChanged(doc, type))
+
+    def _setType(self, docId, type):
         from bson import ObjectId
-        self.mongo['comment'].update({'_id' : ObjectId(docId)},
-                                     {"$set" : {"type" : type}},
-                                     multi=False, safe=True)
-        self.lastTime = 0
+        now = datetime.datetime.now(tzlocal())
+        self._mongo('update', {'_id' : ObjectId(docId)},
+                    {"$set" : {"type" : type, "typeChanged" : now}},
+                    multi=False, safe=True)
+        return self._mongo('find_one', {'_id' : ObjectId(docId)})
+
+    def setTypes(self, docIds, type):
+        """setType for many comments in one update; returns their parents"""
+        return self._then(self._inThread(self._setTypes, docIds, type),
+                          lambda docs: self._typesChanged(docs, type))
+
+    def typesChanged(self, docIds, type):
+        """
+        catch up with another process's setTypes(docIds, type).
+        Returns the parents that changed
+        """
+        from bson import ObjectId
+        spec = {'_id' : {'$in' : [ObjectId(i) for i in docIds]}}
+        return self._then(self._inThread(self._mongo, 'find', spec),
+                          lambda docs: self._typesChanged(docs, type))
+
+    def _typesChanged(self, docs, type):
+        return set(p for p in (self._typeChanged(doc, type) for doc in docs)
+                   if p is not None)
+
+    def _setTypes(self, docIds, type):
+        from bson import ObjectId
+        spec = {'_id' : {'$in' : [ObjectId(i) for i in docIds]}}
+        now = datetime.datetime.now(tzlocal())
+        self._mongo('update', spec,
+                    {"$set" : {"type" : type, "typeChanged" : now}},
+                    multi=True, safe=True)
+        return self._mongo('find', spec)
+
+    def _typeChanged(self, doc, type):
+        if not self.incremental:
+            self.lastTime = 0 # the full graph has to be rebuilt
+        if doc is None:
+            return None
+        if type == "spam":
+            parent = self._removeDoc(doc)
+            if parent is not None:
+                return parent
+        else:
+            self._addDoc(doc)
+        return URIRef(doc['topic']) if doc.get('topic') else None
             
     """
     what this api should be:
@@ -136,6 +1022,6 @@ class DbMongo(_shared):
     getCommentCount(parent) -> n
     setSpam(uri, isSpam)
     getRecentComments(n) -> [(uri, t, user, content, isSpam)]
-    getCommentsByUser(user, paging)
+    getCommentsByUser(user, limit, before, after) -> newest first
     """
     
@@ -0,0 +1,305 @@
+import unittest, datetime, tempfile, copy, shutil, os
+from bson import ObjectId
+from rdflib import URIRef, Literal, RDF
+from rdflib.graph import Graph
+from rdflib.compare import isomorphic
+import db
+from db import (CommentIndex, DbMongo, page, commentDoc, parseDoc, docN3,
+                docFields, SIOC, DCTERMS, CONTENT, XS, FOAF)
+
+def row(minute, docId, name=None):
+    return (datetime.datetime(2013, 1, 1, 12, minute), name,
+            Literal("hi %s" % docId), docId, URIRef("http://example.com/u"))
+
+class TestCommentIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = CommentIndex()
+        self.post = URIRef("http://example.com/post")
+
+    def testRowsAreSortedByCreated(self):
+        self.index.add(self.post, row(5, 'b'))
+        self.index.add(self.post, row(1, 'a'))
+        self.assertEqual([r[3] for r in self.index.rows(self.post)], ['a', 'b'])
+        self.assertEqual(self.index.count(self.post), 2)
+
+    def testRemove(self):
+        self.index.add(self.post, row(1, 'a'))
+        self.assertEqual(self.index.remove('a'), self.post)
+        self.assertEqual(self.index.count(self.post), 0)
+        self.assertEqual(self.index.remove('a'), None)
+
+    def testVersionIsTheSameInAnotherProcess(self):
+        # e.g. another --worker, which got the same comments another way
+        other = CommentIndex()
+        for docId in ['a', 'b', 'c']:
+            self.index.add(self.post, row(1, docId))
+        for docId in ['c', 'x', 'a', 'b']:
+            other.add(self.post, row(1, docId))
+        other.remove('x')
+        self.assertEqual(other.version(self.post),
+                         self.index.version(self.post))
+
+    def testRefreshNames(self):
+        self.index.add(self.post, row(1, 'a'))
+        self.index.refreshNames(lambda creator: Literal("drew"))
+        self.assertEqual(self.index.rows(self.post)[0][1], Literal("drew"))
+
+    def testVersionChangesWithNewCommentsAndRemovals(self):
+        self.index.add(self.post, row(1, 'a'))
+        v1 = self.index.version(self.post)
+        self.index.add(self.post, row(5, 'b'))
+        v2 = self.index.version(self.post)
+        self.index.remove('a')
+        v3 = self.index.version(self.post)
+        self.assertEqual(len(set([v1, v2, v3])), 3)
+        self.index.add(self.post, row(1, 'a'))
+        self.index.remove('b')
+        self.assertEqual(self.index.version(self.post), v1)
+        self.assertEqual(self.index.version(URIRef("http://example.com/other")),
+                         (None, 0, 0))
+
+    def testByUserAcrossParentsNewestFirst(self):
+        other = URIRef("http://example.com/other")
+        self.index.add(self.post, row(1, 'a'))
+        self.index.add(other, row(3, 'b'))
+        self.index.add(self.post, row(5, 'c'))
+        u = URIRef("http://example.com/u")
+        self.assertEqual([(r[3], r[5]) for r in self.index.byUser(u)],
+                         [('c', self.post), ('b', other), ('a', self.post)])
+        self.assertEqual([r[3] for r in self.index.byUser(
+            u, limit=1, before=row(5, 'c')[0])], ['b'])
+        self.index.remove('b')
+        self.index.refreshNames(lambda creator: Literal("drew"))
+        self.assertEqual([(r[3], r[1]) for r in self.index.byUser(u)],
+                         [('c', Literal("drew")), ('a', Literal("drew"))])
+        self.assertEqual(self.index.byUser(URIRef("http://example.com/v")), [])
+
+class TestPage(unittest.TestCase):
+    rows = range(10)
+    key = staticmethod(lambda r: r)
+
+    def testLimitAloneGivesTheNewest(self):
+        self.assertEqual(page(self.rows, self.key, 3), [7, 8, 9])
+
+    def testBefore(self):
+        self.assertEqual(page(self.rows, self.key, 3, before=5), [2, 3, 4])
+
+    def testAfterPagesForward(self):
+        self.assertEqual(page(self.rows, self.key, 3, after=5), [6, 7, 8])
+
+    def testBetweenWithKeep(self):
+        self.assertEqual(page(self.rows, self.key, before=8, after=2,
+                              keep=lambda r: r % 2),
+                         [3, 5, 7])
+
+class TestCommentDoc(unittest.TestCase):
+    def setUp(self):
+        post = URIRef("http://example.com/post")
+        self.comment = URIRef("http://bigasterisk.com/comment/1")
+        self.user = URIRef("http://bigasterisk.com/guest/1")
+        self.stmts = [
+            (post, SIOC.has_reply, self.comment),
+            (self.comment, DCTERMS.created,
+             Literal("2013-01-01T12:00:00-08:00",
+                     datatype=URIRef("http://www.w3.org/2001/XMLSchema#dateTime"))),
+            (self.comment, SIOC.has_creator, self.user),
+            (self.comment, CONTENT.encoded,
+             Literal(u'say "hi" \u00e9', datatype=RDF.XMLLiteral)),
+            ]
+
+    def testTriplesRoundTrip(self):
+        doc = commentDoc(self.stmts, None)
+        expected = Graph()
+        for s in self.stmts:
+            expected.add(s)
+        self.assertTrue(isomorphic(parseDoc(doc), expected))
+        fromN3 = Graph()
+        fromN3.parse(data=docN3(doc), format="n3")
+        self.assertTrue(isomorphic(fromN3, expected))
+
+    def testListingFieldsMatchDocFields(self):
+        doc = commentDoc(self.stmts, None)
+        self.assertEqual(docFields(parseDoc(doc)),
+                         dict((k, doc[k]) for k in ['uri', 'creator', 'content']))
+        self.assertEqual(doc['created'].hour, 12)
+
+    def testOldDocsWithOnlyN3(self):
+        doc = {'n3' : docN3(commentDoc(self.stmts, None))}
+        self.assertEqual(parseDoc(doc).value(self.comment, SIOC.has_creator),
+                         self.user)
+
+class FakeCollection(object):
+    """the parts of a pymongo collection that DbMongo uses"""
+    def __init__(self):
+        self.docs = []
+
+    def ensure_index(self, key):
+        pass
+
+    def _matches(self, doc, spec):
+        for key, want in spec.items():
+            value = doc.get(key)
+            if not isinstance(want, dict):
+                if value != want:
+                    return False
+                continue
+            for op, arg in want.items():
+                if ((op == '$ne' and value == arg) or
+                    (op == '$gte' and (value is None or value < arg)) or
+                    (op == '$in' and value not in arg)):
+                    return False
+        return True
+
+    def insert(self, docs, safe=False):
+        for doc in docs if isinstance(docs, list) else [docs]:
+            doc.setdefault('_id', ObjectId())
+            self.docs.append(copy.deepcopy(doc))
+
+    def find(self, spec=None, sort=None, limit=0):
+        found = [copy.deepcopy(d) for d in self.docs
+                 if self._matches(d, spec or {})]
+        for key, direction in reversed(sort or []):
+            found.sort(key=lambda d: d.get(key), reverse=direction < 0)
+        return found[:limit] if limit else found
+
+    def find_one(self, spec=None, **kw):
+        found = self.find(spec, **kw)
+        return found[0] if found else None
+
+    def update(self, spec, change, multi=False, safe=False):
+        for doc in self.docs:
+            if self._matches(doc, spec):
+                doc.update(change['$set'])
+                if not multi:
+                    break
+
+post = URIRef("http://example.com/post")
+
+def stmts(n, second):
+    comment = URIRef("http://bigasterisk.com/comment/%s" % n)
+    return [(post, SIOC.has_reply, comment),
+            (comment, DCTERMS.created, Literal(
+                "2013-01-01T12:00:%02d-08:00" % second, datatype=XS['dateTime'])),
+            (comment, SIOC.has_creator, URIRef("http://example.com/user")),
+            (comment, CONTENT.encoded, Literal("hi %s" % n,
+                                               datatype=RDF.XMLLiteral))]
+
+class TestDbMongo(unittest.TestCase):
+    def setUp(self):
+        self.mongo = {'comment' : FakeCollection()}
+        self.access = tempfile.NamedTemporaryFile(suffix=".n3")
+        self.access.write('<http://example.com/user> '
+                          '<http://xmlns.com/foaf/0.1/name> "someone" .\n')
+        self.access.flush()
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self, mongo=None):
+        return DbMongo(mongo or self.mongo, accessFile=self.access.name)
+
+    def testCommentInsertedAfterANewerOneIsSynced(self):
+        a, b, reader = self.open(), self.open(), self.open()
+        b.writeFile(stmts(2, second=5), URIRef(post + "/comments"), [])
+        self.assertEqual(reader.getCommentCount(post), 1)
+        # a stamped its comment first, but its insert landed second
+        a.writeFile(stmts(1, second=3), URIRef(post + "/comments"), [])
+        self.assertEqual([r[2] for r in reader.getCommentsForParent(post)],
+                         [u"hi 1", u"hi 2"])
+
+    def testPollsOnlyRereadTheOverlap(self):
+        a = self.open()
+        for n in range(40):
+            a.writeFile(stmts(n, second=0), URIRef(post + "/comments"), [])
+        # a minute apart, all written by a, so no sync saw them arrive
+        coll = self.mongo['comment']
+        for i, doc in enumerate(coll.docs):
+            doc['created'] += datetime.timedelta(minutes=i)
+        a.sync()
+        self.assertEqual(a.lastCreated, coll.docs[-1]['created'])
+        found = []
+        find = coll.find
+        def spy(spec, **kw):
+            found.append((sorted(spec), len(find(spec, **kw))))
+            return find(spec, **kw)
+        coll.find = spy
+        a.sync()
+        self.assertEqual(found, [(['created', 'type'], 2),
+                                 (['typeChanged'], 0)])
+
+    def testSpamFromAnotherWorkerIsDroppedWithoutTheMessage(self):
+        a, b = self.open(), self.open()
+        a.writeFile(stmts(1, second=1), URIRef(post + "/comments"), [])
+        self.assertEqual(b.getCommentCount(post), 1)
+        # a's datagram to b is lost, so b never calls typesChanged
+        a.setTypes([str(self.mongo['comment'].docs[0]['_id'])], "spam")
+        self.assertEqual(b.getCommentCount(post), 0)
+        a.setTypes([str(self.mongo['comment'].docs[0]['_id'])], "ok")
+        self.assertEqual(b.getCommentCount(post), 1)
+
+    def testRowsDontChangeUnderTheCaller(self):
+        a = self.open()
+        a.writeFile(stmts(1, second=1), URIRef(post + "/comments"), [])
+        rows = a.getCommentsForParent(post)
+        a.writeFile(stmts(2, second=2), URIRef(post + "/comments"), [])
+        self.assertEqual(len(rows), 1)
+
+    def testStoresWithTheSameCommentsAgreeOnVersions(self):
+        a = self.open()
+        for n in range(3):
+            a.writeFile(stmts(n, second=n), URIRef(post + "/comments"), [])
+        a.setType(str(self.mongo['comment'].docs[1]['_id']), "spam")
+        b = self.open()
+        self.assertEqual(b.getCommentVersion(post), a.getCommentVersion(post))
+
+    def snapshotOfThree(self):
+        a = self.open()
+        for n in range(3):
+            a.writeFile(stmts(n, second=n), URIRef(post + "/comments"), [])
+        a.setType(str(self.mongo['comment'].docs[1]['_id']), "spam")
+        path = os.path.join(self.dir, "snapshot.pickle")
+        a.saveSnapshot(path)
+        return a, path
+
+    def testSnapshotRoundTrip(self):
+        a, path = self.snapshotOfThree()
+        # with no docs in mongo, all b knows is from the snapshot
+        b = self.open({'comment' : FakeCollection()})
+        self.assertTrue(b.loadSnapshot(path))
+        self.assertEqual(b.getCommentsForParent(post),
+                         a.getCommentsForParent(post))
+        self.assertEqual(b.getCommentCount(post), 2)
+        self.assertEqual(b.getCommentVersion(post), a.getCommentVersion(post))
+        self.assertEqual(b.triples, a.triples)
+        self.assertEqual(len(b.getGraph()), b.triples)
+        self.assertEqual(b.value(URIRef("http://example.com/user"), FOAF.name),
+                         Literal("someone"))
+        comment = URIRef("http://bigasterisk.com/comment/2")
+        created = b.value(comment, DCTERMS.created)
+        self.assertEqual(created, a.value(comment, DCTERMS.created))
+        self.assertEqual(created.toPython(),
+                         a.value(comment, DCTERMS.created).toPython())
+
+    def testSpamMarkedAfterTheSnapshotStaysGone(self):
+        a, path = self.snapshotOfThree()
+        a.setType(str(self.mongo['comment'].docs[2]['_id']), "spam")
+        self.assertEqual(a.getCommentCount(post), 1)
+        b = self.open()
+        self.assertTrue(b.loadSnapshot(path))
+        self.assertEqual(b.getCommentCount(post), 1)
+        b.saveSnapshot(path)
+        c = self.open()
+        c.loadSnapshot(path)
+        self.assertEqual(c.getCommentCount(post), 1)
+
+    def testSnapshotFromAnotherVersionIsIgnored(self):
+        saved = db.SNAPSHOT_VERSION
+        db.SNAPSHOT_VERSION = -1
+        try:
+            a, path = self.snapshotOfThree()
+        finally:
+            db.SNAPSHOT_VERSION = saved
+        b = self.open({'comment' : FakeCollection()})
+        self.assertFalse(b.loadSnapshot(path))
+        self.assertEqual(b.getCommentCount(post), 0)
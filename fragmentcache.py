@@ -0,0 +1,48 @@
+"""
+LRU cache of rendered comment fragments, bounded by total size
+"""
+from collections import OrderedDict
+
+class FragmentCache(object):
+    def __init__(self, maxBytes=16 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self.entries = OrderedDict() # key : (parent, text), oldest first
+        self.keysForParent = {} # parent : set of keys
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        try:
+            parent, text = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = (parent, text)
+        self.hits += 1
+        return text
+
+    def put(self, key, parent, text):
+        """key should include parent, plus whatever else varies the render"""
+        self._drop(key)
+        if len(text) > self.maxBytes:
+            return
+        self.entries[key] = (parent, text)
+        self.keysForParent.setdefault(parent, set()).add(key)
+        self.bytes += len(text)
+        while self.bytes > self.maxBytes:
+            self._drop(next(iter(self.entries)))
+
+    def invalidateParent(self, parent):
+        for key in list(self.keysForParent.get(parent, ())):
+            self._drop(key)
+
+    def _drop(self, key):
+        try:
+            parent, text = self.entries.pop(key)
+        except KeyError:
+            return
+        self.bytes -= len(text)
+        keys = self.keysForParent[parent]
+        keys.discard(key)
+        if not keys:
+            del self.keysForParent[parent]
@@ -0,0 +1,31 @@
+import unittest
+from fragmentcache import FragmentCache
+
+class TestFragmentCache(unittest.TestCase):
+    def testHitAndMiss(self):
+        c = FragmentCache()
+        self.assertEqual(c.get(('p', True)), None)
+        c.put(('p', True), 'p', 'html')
+        self.assertEqual(c.get(('p', True)), 'html')
+        self.assertEqual((c.hits, c.misses), (1, 1))
+
+    def testInvalidateParentDropsEveryVariant(self):
+        c = FragmentCache()
+        c.put(('p', True), 'p', 'a')
+        c.put(('p', False), 'p', 'b')
+        c.put(('q', True), 'q', 'c')
+        c.invalidateParent('p')
+        self.assertEqual(c.get(('p', True)), None)
+        self.assertEqual(c.get(('p', False)), None)
+        self.assertEqual(c.get(('q', True)), 'c')
+        self.assertEqual(c.bytes, 1)
+
+    def testEvictsLeastRecentlyUsed(self):
+        c = FragmentCache(maxBytes=10)
+        c.put('a', 'a', '12345')
+        c.put('b', 'b', '12345')
+        c.get('a')
+        c.put('c', 'c', '12345')
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual(c.get('a'), '12345')
+        self.assertTrue(c.bytes <= 10)
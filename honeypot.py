@@ -4,49 +4,112 @@ http://trac.edgewall.org/browser/plugins/0.12/spam-filter-captcha/tracspamfilter
 BSD license: http://trac.edgewall.org/wiki/TracLicense
 
 """
-import logging
-from dns.resolver import query, Timeout, NXDOMAIN, NoAnswer, NoNameservers
+import logging, time
+from collections import OrderedDict
+from twisted.internet import defer
+from twisted.names import client
+from twisted.names.error import DomainError, DNSQueryTimeoutError
 log = logging.getLogger()
 
 class HoneypotChecker(object):
-    def __init__(self, key):
+    def __init__(self, key, resolver=None, timeout=3,
+                 spammerTtl=24 * 3600, okTtl=3600, maxVerdicts=10000,
+                 clock=time.time):
         """
         key is a string you get from registering with honeypot
+
+        resolver is a twisted.names resolver (default reads
+        /etc/resolv.conf). Lookups give up after timeout secs, and then
+        we let the ip through. Verdicts are remembered for spammerTtl
+        or okTtl secs, and past maxVerdicts we drop the least recently
+        used ones.
         """
         self.key = key
+        if resolver is None:
+            resolver = client.Resolver(resolv='/etc/resolv.conf')
+        self.resolver = resolver
+        self.timeout = timeout
+        self.spammerTtl = spammerTtl
+        self.okTtl = okTtl
+        self.maxVerdicts = maxVerdicts
+        self.clock = clock
+        # ip : (isSpammer, expireTime), least recently used first
+        self.verdicts = OrderedDict()
 
     def check(self, ip):
         """
-        raises if this ip fails the httpbl check
+        deferred that fails with ValueError if this ip fails the
+        httpbl check
         """
-        
+        now = self.clock()
+        try:
+            isSpammer, expire = self.verdicts.pop(ip)
+        except KeyError:
+            pass
+        else:
+            if now < expire:
+                self.verdicts[ip] = (isSpammer, expire)
+                return self._result(ip, isSpammer)
+
         reverse_octal = '.'.join(reversed(ip.split('.')))
         addr = '%s.%s.dnsbl.httpbl.org' % (self.key, reverse_octal)
         log.debug('Querying Http:BL: %s' % addr)
-        try:
-            dns_answer = query(addr)
-            answer = [int(i) for i in str(dns_answer[0]).split('.')]
-            if answer[0] != 127:
-                log.warn('Invalid Http:BL reply for IP "%s": %s' %
-                                 (ip, dns_answer))
-                return
+        d = self.resolver.lookupAddress(addr, timeout=(self.timeout,))
+        d.addCallbacks(self._gotAnswer, self._lookupFailed,
+                       callbackArgs=(ip,), errbackArgs=(ip,))
+        d.addCallback(lambda isSpammer: self._result(ip, isSpammer))
+        return d
 
-            # TODO: answer[1] represents number of days since last activity
-            #       and answer[2] is treat score assigned by Project Honey
-            #       Pot. We could use both to adjust karma.
+    def _result(self, ip, isSpammer):
+        if isSpammer:
+            return defer.fail(ValueError("IP %s rejected" % ip))
+        return defer.succeed(None)
 
-            is_suspicious = answer[3] & 1
-            is_spammer =    answer[3] & 4
+    def _remember(self, ip, isSpammer):
+        now = self.clock()
+        ttl = self.spammerTtl if isSpammer else self.okTtl
+        self.verdicts.pop(ip, None)
+        self.verdicts[ip] = (isSpammer, now + ttl)
+        self._evict(now)
+        return isSpammer
 
-            if is_spammer:
-                raise ValueError("IP %s rejected" % ip)
+    def _evict(self, now):
+        while self.verdicts:
+            ip = next(iter(self.verdicts))
+            if (len(self.verdicts) <= self.maxVerdicts and
+                self.verdicts[ip][1] > now):
+                break
+            del self.verdicts[ip]
 
+    def _gotAnswer(self, result, ip):
+        answers, authority, additional = result
+        quads = [rr.payload.dottedQuad() for rr in answers
+                 if hasattr(rr.payload, 'dottedQuad')]
+        if not quads:
+            return self._remember(ip, False)
+        answer = [int(i) for i in quads[0].split('.')]
+        if answer[0] != 127:
+            log.warn('Invalid Http:BL reply for IP "%s": %s' %
+                     (ip, quads[0]))
+            return False
 
-        except NXDOMAIN:
-            # not blacklisted on this server
-            return
+        # TODO: answer[1] represents number of days since last activity
+        #       and answer[2] is treat score assigned by Project Honey
+        #       Pot. We could use both to adjust karma.
 
-        except (Timeout, NoAnswer, NoNameservers), e:
-            log.warn('Error checking Http:BL for IP "%s": %s' %
-                     (ip, e))
+        is_suspicious = answer[3] & 1
+        is_spammer =    answer[3] & 4
+
+        return self._remember(ip, bool(is_spammer))
 
+    def _lookupFailed(self, failure, ip):
+        if failure.check(DomainError):
+            # not blacklisted on this server
+            return self._remember(ip, False)
+        if failure.check(DNSQueryTimeoutError, defer.TimeoutError):
+            log.warn('Timeout checking Http:BL for IP "%s"' % ip)
+        else:
+            log.warn('Error checking Http:BL for IP "%s": %s' %
+                     (ip, failure.getErrorMessage()))
+        # uncached, so we'll ask again next time
+        return False
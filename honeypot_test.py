@@ -0,0 +1,68 @@
+import unittest
+from twisted.internet import defer
+from twisted.names import dns
+from twisted.names.error import DNSNameError, DNSQueryTimeoutError
+from honeypot import HoneypotChecker
+
+class FakeResolver(object):
+    """answers from a dict of name : dotted quad, or name : Exception"""
+    def __init__(self, answers):
+        self.answers = answers
+        self.queries = []
+
+    def lookupAddress(self, name, timeout=None):
+        self.queries.append(name)
+        answer = self.answers.get(name, DNSNameError(name))
+        if isinstance(answer, Exception):
+            return defer.fail(answer)
+        return defer.succeed((
+            [dns.RRHeader(name, payload=dns.Record_A(answer))], [], []))
+
+def outcome(d):
+    ret = []
+    d.addCallbacks(lambda _: ret.append('ok'),
+                   lambda f: ret.append(f.trap(ValueError) and 'rejected'))
+    return ret[0]
+
+class TestHoneypotChecker(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.resolver = FakeResolver({
+            'k.4.3.2.1.dnsbl.httpbl.org' : '127.3.20.4', # spammer
+            'k.8.7.6.5.dnsbl.httpbl.org' : '127.3.20.1', # just suspicious
+            'k.9.9.9.9.dnsbl.httpbl.org' : DNSQueryTimeoutError('slow'),
+            })
+        self.checker = HoneypotChecker('k', resolver=self.resolver,
+                                       spammerTtl=100, okTtl=10,
+                                       clock=lambda: self.now)
+
+    def testSpammerIsRejected(self):
+        self.assertEqual(outcome(self.checker.check('1.2.3.4')), 'rejected')
+
+    def testSuspiciousAndUnlistedPass(self):
+        self.assertEqual(outcome(self.checker.check('5.6.7.8')), 'ok')
+        self.assertEqual(outcome(self.checker.check('10.0.0.1')), 'ok')
+
+    def testTimeoutPassesAndIsNotCached(self):
+        self.assertEqual(outcome(self.checker.check('9.9.9.9')), 'ok')
+        self.checker.check('9.9.9.9')
+        self.assertEqual(len(self.resolver.queries), 2)
+
+    def testVerdictsExpireSeparately(self):
+        outcome(self.checker.check('1.2.3.4'))
+        self.checker.check('10.0.0.1')
+        self.now += 50
+        self.assertEqual(outcome(self.checker.check('1.2.3.4')), 'rejected')
+        self.checker.check('10.0.0.1')
+        self.assertEqual(len(self.resolver.queries), 3)
+
+    def testLeastRecentlyUsedVerdictsAreDropped(self):
+        self.checker.maxVerdicts = 2
+        self.checker.check('1.2.3.4')
+        self.checker.check('10.0.0.1')
+        self.checker.check('1.2.3.4')
+        self.checker.check('10.0.0.2')
+        self.assertEqual(self.checker.verdicts.keys(),
+                         ['1.2.3.4', '10.0.0.2'])
+        self.assertEqual(outcome(self.checker.check('1.2.3.4')), 'rejected')
+        self.assertEqual(len(self.resolver.queries), 3)
@@ -1,15 +1,19 @@
 # one time import from files to mongo
-import os
+import os, time
 from db import DbMongo
 from rdflib.graph import ConjunctiveGraph
 db = DbMongo()
 
-for name in os.listdir("commentstore"):
-    filename = os.path.join("commentstore", name)
-    if os.path.isdir(filename):
-        continue
-    print filename
-    g = ConjunctiveGraph()
-    g.parse(filename, format="n3")
-    
-    db.writeFile(list(g), None, name[len('post-'):].split('-'))
+def comments(names):
+    for name in names:
+        g = ConjunctiveGraph()
+        g.parse(os.path.join("commentstore", name), format="n3")
+        yield list(g), None
+
+names = [name for name in sorted(os.listdir("commentstore"))
+         if not os.path.isdir(os.path.join("commentstore", name))]
+t1 = time.time()
+def progress(done):
+    print "%s of %s comments, %.0f/sec" % (done, len(names),
+                                          done / (time.time() - t1))
+db.importComments(comments(names), progress=progress)
@@ -0,0 +1,202 @@
+"""
+comment store that needs no mongo: every comment, and every change to
+comments' types, is one json line appended to comments.log.
+comments.idx gets an (offset, length, crc) entry for each line once
+the line is fsync'd, so a line without an entry is a write that never
+finished. At startup we replay the whole log into memory.
+
+  bin/python logstore.py [commentstore]
+
+imports the old commentstore/*.nt files into commentlog/.
+"""
+import os, sys, json, struct, zlib, heapq, datetime, logging, time
+from uuid import uuid4
+from dateutil.parser import parse
+from dateutil.tz import tzlocal
+from rdflib import URIRef
+from rdflib.graph import ConjunctiveGraph
+from db import _indexed, commentDoc, recentCommentRow, ACCESS_FILE, CONTENT
+from sanitize import sanitize_html
+
+log = logging.getLogger("db")
+
+ENTRY = struct.Struct("<QIi") # offset, length, crc32 of one log line
+
+class DbLog(_indexed):
+    def __init__(self, path="commentlog", accessFile=ACCESS_FILE,
+                 checkInterval=0):
+        """checkInterval is the most often reads will stat access.n3"""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.logPath = os.path.join(path, "comments.log")
+        self.idxPath = os.path.join(path, "comments.idx")
+        self.accessFile = accessFile
+        self.checkInterval = checkInterval
+        self.docs = {} # docId : doc, spam too
+        self._reset()
+        self._replay()
+        self.logFile = open(self.logPath, "ab")
+        self.idxFile = open(self.idxPath, "ab")
+
+    def _replay(self):
+        t1 = time.time()
+        for p in [self.logPath, self.idxPath]:
+            open(p, "ab").close()
+        data = open(self.logPath, "rb").read()
+        entries = readEntries(open(self.idxPath, "rb").read(), data)
+        if entries is None:
+            log.warn("%s doesn't match the log; rebuilding it" % self.idxPath)
+            entries = entriesFromLines(data)
+            writeFile(self.idxPath, "".join(ENTRY.pack(*e) for e in entries))
+        end = 0
+        for offset, length, crc in entries:
+            self._apply(json.loads(data[offset:offset + length]))
+            end = offset + length + 1
+        if end < len(data):
+            log.warn("dropping %s bytes of unfinished writes from %s" %
+                     (len(data) - end, self.logPath))
+            with open(self.logPath, "r+b") as f:
+                f.truncate(end)
+        log.info("replayed %s comments from %s in %f sec" %
+                 (len(self.docs), self.logPath, time.time() - t1))
+
+    def _apply(self, record):
+        if 'doc' in record:
+            doc = loadDoc(record['doc'])
+            self.docs[doc['_id']] = doc
+            if doc.get('type') != 'spam':
+                self._addDoc(doc)
+        elif 'setTypes' in record:
+            return set(filter(None, [self._applyType(docId, record['type'])
+                                     for docId in record['setTypes']]))
+        else:
+            return self._applyType(record['setType'], record['type'])
+
+    def _applyType(self, docId, type):
+        doc = self.docs.get(docId)
+        if doc is None:
+            return None
+        doc['type'] = type
+        if doc['type'] == 'spam':
+            return self._removeDoc(doc) or URIRef(doc['topic'])
+        self._addDoc(doc)
+        return URIRef(doc['topic'])
+
+    def _append(self, record):
+        line = json.dumps(record)
+        self.logFile.seek(0, 2)
+        offset = self.logFile.tell()
+        self.logFile.write(line + "\n")
+        self.logFile.flush()
+        os.fsync(self.logFile.fileno())
+        self.idxFile.write(ENTRY.pack(offset, len(line), zlib.crc32(line)))
+        self.idxFile.flush()
+        os.fsync(self.idxFile.fileno())
+        return self._apply(record)
+
+    def writeFile(self, stmts, ctx, fileWords, html=None):
+        doc = commentDoc(stmts, ctx, html)
+        doc['_id'] = uuid4().hex
+        self._append({'doc' : dumpDoc(doc)})
+
+    def setType(self, docId, type):
+        """returns the parent of the comment, if we know it"""
+        if docId not in self.docs:
+            return None
+        return self._append({'setType' : docId, 'type' : type})
+
+    def setTypes(self, docIds, type):
+        """setType for many comments in one log line; returns their parents"""
+        docIds = [i for i in docIds if i in self.docs]
+        if not docIds:
+            return set()
+        return self._append({'setTypes' : docIds, 'type' : type})
+
+    def getRecentComments(self, n=10, notOlderThan=None, withSpam=False):
+        docs = self.docs.itervalues()
+        if not withSpam:
+            docs = (d for d in docs if d.get('type') != 'spam')
+        if notOlderThan is not None:
+            oldest = (datetime.datetime.now(tzlocal()) -
+                      datetime.timedelta(days=notOlderThan))
+            docs = (d for d in docs if d['created'] > oldest)
+        for doc in heapq.nlargest(n, docs, key=lambda d: d['created']):
+            yield recentCommentRow(doc)
+
+    def compact(self):
+        """rewrite the log without the spam and the setType records"""
+        keep = sorted((d for d in self.docs.values() if d.get('type') != 'spam'),
+                      key=lambda d: d['created'])
+        lines, entries, offset = [], [], 0
+        for doc in keep:
+            line = json.dumps({'doc' : dumpDoc(doc)})
+            lines.append(line + "\n")
+            entries.append(ENTRY.pack(offset, len(line), zlib.crc32(line)))
+            offset += len(line) + 1
+        # if we die between these renames, the crcs won't match and the
+        # next startup rebuilds the idx from the new log
+        writeFile(self.logPath + ".new", "".join(lines))
+        writeFile(self.idxPath + ".new", "".join(entries))
+        os.rename(self.logPath + ".new", self.logPath)
+        os.rename(self.idxPath + ".new", self.idxPath)
+        self.logFile.close()
+        self.idxFile.close()
+        self.logFile = open(self.logPath, "ab")
+        self.idxFile = open(self.idxPath, "ab")
+        dropped = len(self.docs) - len(keep)
+        self.docs = dict((d['_id'], d) for d in keep)
+        log.info("compacted %s: dropped %s spam comments" %
+                 (self.logPath, dropped))
+
+def dumpDoc(doc):
+    doc = dict(doc)
+    doc['created'] = doc['created'].isoformat()
+    return doc
+
+def loadDoc(doc):
+    doc['created'] = parse(doc['created'])
+    return doc
+
+def readEntries(idx, data):
+    """idx entries, or None if they don't describe this log data"""
+    entries = [ENTRY.unpack_from(idx, i)
+               for i in range(0, len(idx) - len(idx) % ENTRY.size, ENTRY.size)]
+    for offset, length, crc in entries:
+        if zlib.crc32(data[offset:offset + length]) != crc:
+            return None
+    return entries
+
+def entriesFromLines(data):
+    """idx entries for every complete line of log data"""
+    entries, offset = [], 0
+    for line in data.split("\n")[:-1]:
+        entries.append((offset, len(line), zlib.crc32(line)))
+        offset += len(line) + 1
+    return entries
+
+def writeFile(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def importNtFiles(db, storeDir="commentstore"):
+    """
+    load the old one-file-per-comment store, like initmongo.py does.
+    The html is sanitized here, so replays won't have to
+    """
+    for name in sorted(os.listdir(storeDir)):
+        filename = os.path.join(storeDir, name)
+        if os.path.isdir(filename):
+            continue
+        print filename
+        g = ConjunctiveGraph()
+        g.parse(filename, format="n3")
+        html = None
+        for content in g.objects(None, CONTENT.encoded):
+            html = sanitize_html(content)
+        db.writeFile(list(g), None, name[len('post-'):].split('-'),
+                     html=html)
+
+if __name__ == '__main__':
+    importNtFiles(DbLog(), *sys.argv[1:])
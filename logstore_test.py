@@ -0,0 +1,132 @@
+import unittest, tempfile, shutil, os
+from rdflib import URIRef, Literal, RDF
+from rdflib.graph import Graph
+from logstore import DbLog, importNtFiles
+from db import SIOC, DCTERMS, CONTENT, XS
+
+post = URIRef("http://example.com/post")
+
+def stmts(n):
+    comment = URIRef("http://bigasterisk.com/comment/%s" % n)
+    return [(post, SIOC.has_reply, comment),
+            (comment, DCTERMS.created, Literal(
+                "2013-01-01T12:%02d:00-08:00" % n, datatype=XS['dateTime'])),
+            (comment, SIOC.has_creator, URIRef("http://example.com/user")),
+            (comment, CONTENT.encoded, Literal("hi %s" % n,
+                                               datatype=RDF.XMLLiteral))]
+
+class TestDbLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.access = tempfile.NamedTemporaryFile(suffix=".n3")
+        self.access.write('<http://example.com/user> '
+                          '<http://xmlns.com/foaf/0.1/name> "someone" .\n')
+        self.access.flush()
+        self.db = self.open()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        return DbLog(self.dir, accessFile=self.access.name)
+
+    def docIds(self):
+        return [r['docId'] for r in self.db.getRecentComments(10, withSpam=True)]
+
+    def testReplayAfterRestart(self):
+        self.db.writeFile(stmts(2), None, [])
+        self.db.writeFile(stmts(1), None, [])
+        self.db = self.open()
+        rows = self.db.getCommentsForParent(post)
+        self.assertEqual([r[2] for r in rows], [u"hi 1", u"hi 2"])
+        self.assertEqual(rows[0][1], Literal("someone"))
+
+    def testSpamSurvivesRestartAndCompactionDropsIt(self):
+        for n in range(3):
+            self.db.writeFile(stmts(n), None, [])
+        spamId = self.docIds()[0]
+        self.assertEqual(self.db.setType(spamId, "spam"), post)
+        self.db = self.open()
+        self.assertEqual(self.db.getCommentCount(post), 2)
+        self.assertEqual(len(self.docIds()), 3)
+        old = self.db.logFile, self.db.idxFile
+        self.db.compact()
+        self.assertTrue(old[0].closed and old[1].closed)
+        self.db = self.open()
+        self.assertEqual(len(self.docIds()), 2)
+        self.assertEqual(self.db.getCommentCount(post), 2)
+
+    def testCommentsByUserSkipsSpam(self):
+        for n in range(5):
+            self.db.writeFile(stmts(n), None, [])
+        user = URIRef("http://example.com/user")
+        rows = self.db.getCommentsByUser(user, limit=2)
+        self.assertEqual([r[2] for r in rows], [u"hi 4", u"hi 3"])
+        self.assertEqual(rows[0][5], post)
+        self.db.setType(rows[1][3], "spam")
+        rows = self.db.getCommentsByUser(user, limit=2, before=rows[0][0])
+        self.assertEqual([r[2] for r in rows], [u"hi 2", u"hi 1"])
+
+    def testCountsForManyPosts(self):
+        self.db.writeFile(stmts(1), None, [])
+        self.db.writeFile(stmts(2), None, [])
+        other = URIRef("http://example.com/other")
+        self.assertEqual(self.db.getCommentCounts([post, other]),
+                         {post : 2, other : 0})
+        self.assertEqual(self.db.getNewestCommentTime([post, other]).minute, 2)
+        self.assertEqual(self.db.getNewestCommentTime([other]), None)
+
+    def testBulkSpamIsOneLogLine(self):
+        for n in range(3):
+            self.db.writeFile(stmts(n), None, [])
+        self.assertEqual(self.db.setTypes(self.docIds()[:2], "spam"),
+                         set([post]))
+        self.assertEqual(len(open(self.db.logPath).readlines()), 4)
+        self.db = self.open()
+        self.assertEqual(self.db.getCommentCount(post), 1)
+
+    def testRecentCommentsNeedNoParsing(self):
+        self.db.writeFile(stmts(1), None, [])
+        doc = self.db.docs.values()[0]
+        del doc['triples'] # parseDoc would fall back to n3
+        doc['n3'] = None
+        row = list(self.db.getRecentComments(1))[0]
+        self.assertEqual((row['uri'], unicode(row['content'])),
+                         (URIRef("http://bigasterisk.com/comment/1"), u"hi 1"))
+
+    def testImportedCommentsAreSanitizedOnce(self):
+        store = os.path.join(self.dir, "commentstore")
+        os.mkdir(store)
+        g = Graph()
+        for s in stmts(1):
+            g.add(s)
+        g.serialize(os.path.join(store, "post-a-b"), format="nt")
+        importNtFiles(self.db, store)
+        self.assertEqual(self.db.docs.values()[0]['html'], u"hi 1")
+
+    def testUnfinishedWriteIsDropped(self):
+        self.db.writeFile(stmts(1), None, [])
+        with open(os.path.join(self.dir, "comments.log"), "ab") as f:
+            f.write('{"doc": {"half')
+        self.db = self.open()
+        self.db.writeFile(stmts(2), None, [])
+        self.db = self.open()
+        self.assertEqual(self.db.getCommentCount(post), 2)
+
+    def testAccessIsOnlyCheckedEveryInterval(self):
+        self.db.writeFile(stmts(1), None, [])
+        self.db.checkInterval = 10
+        now = [1000]
+        self.db.clock = lambda: now[0]
+        self.db.getCommentsForParent(post)
+        self.access.seek(0)
+        self.access.write('<http://example.com/user> '
+                          '<http://xmlns.com/foaf/0.1/name> "renamed" .\n')
+        self.access.flush()
+        os.utime(self.access.name, (0, 0))
+        now[0] += 5
+        self.assertEqual(self.db.getCommentsForParent(post)[0][1],
+                         Literal("someone"))
+        now[0] += 5
+        self.assertEqual(self.db.getCommentsForParent(post)[0][1],
+                         Literal("renamed"))
@@ -0,0 +1,154 @@
+"""
+counters and latency histograms for GET /metrics, in prometheus' text
+format. An observation is a dict lookup and a bisect, and timing one
+adds two time.time() calls, so all of this stays on in production.
+
+Stages of the work are timed with
+
+  with metrics.stage('findComments'):
+      ...
+
+and show up in commentserve_stage_seconds{stage="findComments"}.
+Other parts of the app can add their own numbers with collect().
+"""
+import time, bisect
+from contextlib import contextmanager
+
+PREFIX = "commentserve_"
+
+# secs; prometheus' default buckets
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+HELP = {
+    'request_seconds' : 'time to answer a request, by handler',
+    'requests_total' : 'requests answered, by handler and status',
+    'stage_seconds' : 'time spent in one stage of the work',
+    'graph_update_seconds' : 'time to bring the comment graph up to date',
+    }
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last is +Inf
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        """(le, count) pairs, as prometheus wants them"""
+        total = 0
+        for le, n in zip(self.buckets + ('+Inf',), self.counts):
+            total += n
+            yield le, total
+
+class Metrics(object):
+    """
+    Mongo calls run in threads, so an observation from one can race
+    with the reactor's; an occasional lost count is fine here, and
+    cheaper than a lock on every request
+    """
+    def __init__(self):
+        self.histograms = {} # name : {labels : Histogram}
+        self.counters = {} # name : {labels : number}
+        self.collectors = {} # name : (type, func, labelName)
+
+    def observe(self, name, value, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        try:
+            h = series[key]
+        except KeyError:
+            h = series[key] = Histogram()
+        h.observe(value)
+
+    def count(self, name, n=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + n
+
+    @contextmanager
+    def timed(self, name, **labels):
+        t1 = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - t1, **labels)
+
+    def stage(self, stage, **labels):
+        return self.timed('stage_seconds', stage=stage, **labels)
+
+    def timedDeferred(self, d, name, **labels):
+        """observe how long until d fires, either way. Returns d"""
+        t1 = time.time()
+        def done(result):
+            self.observe(name, time.time() - t1, **labels)
+            return result
+        return d.addBoth(done)
+
+    def collect(self, name, type, func, labelName=None, help=None):
+        """
+        func() is read at each scrape. It returns a number, or with
+        labelName, a dict of label value : number. Collecting the same
+        name again replaces the old func
+        """
+        self.collectors[name] = (type, func, labelName)
+        if help:
+            HELP[name] = help
+
+    def render(self):
+        """the prometheus text exposition of everything"""
+        lines = []
+        for name, series in sorted(self.histograms.items()):
+            header(lines, name, 'histogram')
+            for key, h in sorted(series.items()):
+                for le, n in h.cumulative():
+                    lines.append("%s%s_bucket%s %s" % (
+                        PREFIX, name, labelText(key + (('le', le),)), n))
+                lines.append("%s%s_sum%s %r" % (PREFIX, name, labelText(key),
+                                                float(h.sum)))
+                lines.append("%s%s_count%s %s" % (PREFIX, name, labelText(key),
+                                                  sum(h.counts)))
+        for name, series in sorted(self.counters.items()):
+            header(lines, name, 'counter')
+            for key, n in sorted(series.items()):
+                lines.append("%s%s%s %s" % (PREFIX, name, labelText(key), n))
+        for name, (type, func, labelName) in sorted(self.collectors.items()):
+            value = func()
+            if labelName is None:
+                values = [((), value)]
+            else:
+                values = sorted((((labelName, k),), v)
+                                for k, v in value.items())
+            header(lines, name, type)
+            for key, v in values:
+                if v is not None:
+                    lines.append("%s%s%s %s" % (PREFIX, name, labelText(key), v))
+        return "\n".join(lines) + "\n"
+
+def header(lines, name, type):
+    if name in HELP:
+        lines.append("# HELP %s%s %s" % (PREFIX, name, HELP[name]))
+    lines.append("# TYPE %s%s %s" % (PREFIX, name, type))
+
+def labelText(key):
+    if not key:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, escape(v)) for k, v in key)
+
+def escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+# the one the app reports
+registry = Metrics()
+observe = registry.observe
+count = registry.count
+timed = registry.timed
+stage = registry.stage
+timedDeferred = registry.timedDeferred
+collect = registry.collect
+render = registry.render
@@ -0,0 +1,63 @@
+import unittest
+from twisted.internet import defer
+from metrics import Metrics, Histogram
+
+class TestHistogram(unittest.TestCase):
+    def testCumulativeBuckets(self):
+        h = Histogram(buckets=(.1, 1))
+        for v in [.05, .1, .5, 2]:
+            h.observe(v)
+        self.assertEqual(list(h.cumulative()), [(.1, 2), (1, 3), ('+Inf', 4)])
+        self.assertAlmostEqual(h.sum, 2.65)
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.m = Metrics()
+
+    def testRendersHistogram(self):
+        self.m.observe('stage_seconds', .003, stage='findComments')
+        lines = self.m.render().splitlines()
+        self.assertIn('# TYPE commentserve_stage_seconds histogram', lines)
+        self.assertIn('commentserve_stage_seconds_bucket'
+                      '{stage="findComments",le="0.005"} 1', lines)
+        self.assertIn('commentserve_stage_seconds_bucket'
+                      '{stage="findComments",le="+Inf"} 1', lines)
+        self.assertIn('commentserve_stage_seconds_count'
+                      '{stage="findComments"} 1', lines)
+
+    def testCountsByLabels(self):
+        self.m.count('requests_total', handler='Comments', code=200)
+        self.m.count('requests_total', handler='Comments', code=200)
+        self.m.count('requests_total', handler='Comments', code=304)
+        lines = self.m.render().splitlines()
+        self.assertIn('commentserve_requests_total'
+                      '{code="200",handler="Comments"} 2', lines)
+        self.assertIn('commentserve_requests_total'
+                      '{code="304",handler="Comments"} 1', lines)
+
+    def testTimedCountsFailuresToo(self):
+        try:
+            with self.m.stage('sanitize_html'):
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(
+            sum(self.m.histograms['stage_seconds'][
+                (('stage', 'sanitize_html'),)].counts), 1)
+
+    def testTimedDeferred(self):
+        d = defer.Deferred()
+        self.m.timedDeferred(d, 'stage_seconds', stage='httpbl')
+        self.assertNotIn('stage_seconds', self.m.histograms)
+        d.callback(None)
+        self.assertIn('stage_seconds', self.m.histograms)
+
+    def testCollectorsEscapeLabels(self):
+        fired = {'regex a\\s"b"' : 3}
+        self.m.collect('spam_rejected_total', 'counter', lambda: fired, 'rule')
+        self.m.collect('alert_last_latency_seconds', 'gauge', lambda: None)
+        text = self.m.render()
+        self.assertIn('commentserve_spam_rejected_total'
+                      '{rule="regex a\\\\s\\"b\\""} 3', text)
+        self.assertFalse([line for line in text.splitlines() if
+                          line.startswith('commentserve_alert_last_latency')])
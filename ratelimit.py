@@ -0,0 +1,89 @@
+"""
+admission control for comment posts: token buckets per poster ip and
+per post, checked before we do any of the expensive work
+"""
+import time, math
+from collections import OrderedDict
+
+class TokenBuckets(object):
+    def __init__(self, rate, burst, maxKeys=10000, clock=time.time):
+        """
+        each key gets a bucket of burst tokens that refills at rate
+        tokens/sec; a request takes one. Buckets that have refilled
+        are dropped, since they're the same as a new one, and past
+        maxKeys we drop the least recently used ones.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.maxKeys = maxKeys
+        self.clock = clock
+        self.buckets = OrderedDict() # key : (tokens, time), oldest first
+
+    def allow(self, key):
+        now = self.clock()
+        tokens = self._tokens(key, now)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets.pop(key, None)
+        self.buckets[key] = (tokens, now)
+        self._evict(now)
+        return allowed
+
+    def has(self, key):
+        """whether allow(key) would be True, without taking the token"""
+        return self._tokens(key, self.clock()) >= 1
+
+    def _tokens(self, key, now):
+        try:
+            tokens, t = self.buckets[key]
+        except KeyError:
+            return self.burst
+        return min(self.burst, tokens + (now - t) * self.rate)
+
+    def _evict(self, now):
+        while self.buckets:
+            key = next(iter(self.buckets))
+            if (len(self.buckets) <= self.maxKeys and
+                self._tokens(key, now) < self.burst):
+                break
+            del self.buckets[key]
+
+    def retryAfter(self):
+        """secs until a key that was just refused gets a token"""
+        return int(math.ceil(1 / self.rate))
+
+class RateLimiter(object):
+    """
+    limits on posts per ip and per post. Rates are per minute, since
+    that's the scale comments come at
+    """
+    def __init__(self, ipPerMinute=2, ipBurst=5,
+                 parentPerMinute=6, parentBurst=20, clock=time.time):
+        self.limits = [
+            ('ip', TokenBuckets(ipPerMinute / 60., ipBurst, clock=clock)),
+            ('parent', TokenBuckets(parentPerMinute / 60., parentBurst,
+                                    clock=clock)),
+            ]
+        self.rejected = dict((name, 0) for name, _ in self.limits)
+
+    def check(self, ip, parent):
+        """
+        None if this post may go ahead, else (name of the limit it hit,
+        secs to wait)
+        """
+        limits = zip(self.limits, [ip, parent])
+        # a post one limit refuses mustn't cost a token from the others
+        for (name, buckets), key in limits:
+            if not buckets.has(key):
+                self.rejected[name] += 1
+                return name, buckets.retryAfter()
+        for (name, buckets), key in limits:
+            buckets.allow(key)
+        return None
+
+    def stats(self):
+        ret = dict(('%sRejected' % name, n) for name, n in self.rejected.items())
+        for name, buckets in self.limits:
+            ret['%sBuckets' % name] = len(buckets.buckets)
+        return ret
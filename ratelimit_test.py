@@ -0,0 +1,78 @@
+import unittest
+from ratelimit import TokenBuckets, RateLimiter
+
+class TestTokenBuckets(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.buckets = TokenBuckets(rate=1 / 60., burst=3, maxKeys=5,
+                                    clock=lambda: self.now)
+
+    def testBurstThenRefused(self):
+        self.assertEqual([self.buckets.allow('a') for i in range(5)],
+                         [True, True, True, False, False])
+
+    def testRefillsAtRate(self):
+        for i in range(3):
+            self.buckets.allow('a')
+        self.now += 59
+        self.assertFalse(self.buckets.allow('a'))
+        self.now += 1 # refused tries don't cost anything
+        self.assertTrue(self.buckets.allow('a'))
+        self.assertFalse(self.buckets.allow('a'))
+
+    def testKeysAreSeparate(self):
+        for i in range(3):
+            self.buckets.allow('a')
+        self.assertTrue(self.buckets.allow('b'))
+
+    def testDropsRefilledBuckets(self):
+        self.buckets.allow('a')
+        self.now += 60
+        self.buckets.allow('b')
+        self.assertEqual(self.buckets.buckets.keys(), ['b'])
+
+    def testBoundedUnderManyKeys(self):
+        for i in range(1000):
+            self.buckets.allow('ip%d' % i)
+        self.assertEqual(len(self.buckets.buckets), 5)
+        self.assertEqual(self.buckets.buckets.keys()[-1], 'ip999')
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.limiter = RateLimiter(ipPerMinute=1, ipBurst=2,
+                                   parentPerMinute=6, parentBurst=4,
+                                   clock=lambda: self.now)
+
+    def testOneIpBurst(self):
+        results = [self.limiter.check('1.2.3.4', 'http://example.com/post')
+                   for i in range(10)]
+        self.assertEqual(results, [None, None] + [('ip', 60)] * 8)
+        self.assertEqual(self.limiter.stats()['ipRejected'], 8)
+
+    def testManyIpsOnOnePost(self):
+        results = [self.limiter.check('10.0.0.%d' % i, 'http://example.com/post')
+                   for i in range(10)]
+        self.assertEqual(results, [None] * 4 + [('parent', 10)] * 6)
+        self.assertEqual(self.limiter.stats()['parentRejected'], 6)
+        self.assertEqual(self.limiter.check('10.0.0.1', 'http://example.com/other'),
+                         None)
+
+    def testRefusedPostsDontSpendTheIpsTokens(self):
+        for i in range(4):
+            self.limiter.check('10.0.0.%d' % i, 'http://example.com/post')
+        for i in range(3):
+            self.assertEqual(self.limiter.check('1.2.3.4',
+                                                'http://example.com/post'),
+                             ('parent', 10))
+        self.assertEqual(self.limiter.check('1.2.3.4', 'http://example.com/other'),
+                         None)
+        self.assertEqual(self.limiter.check('1.2.3.4', 'http://example.com/other'),
+                         None)
+
+    def testRecoversAfterBurst(self):
+        for i in range(10):
+            self.limiter.check('1.2.3.4', 'http://example.com/post')
+        self.now += 60
+        self.assertEqual(self.limiter.check('1.2.3.4', 'http://example.com/post'),
+                         None)
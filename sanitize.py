@@ -0,0 +1,29 @@
+"""
+html cleanup for comment content. Comments are sanitized once when
+they're written and the result is stored with them.
+"""
+from html5lib import html5parser, sanitizer
+import metrics
+
+# bump this whenever the allowed elements/attributes change, so stored
+# html from the old policy gets redone (see backfill.py)
+SANITIZER_VERSION = 1
+
+class AnyCase(sanitizer.HTMLSanitizer):
+    def __init__(self, stream, encoding=None, parseMeta=True, useChardet=True,
+                 lowercaseElementName=True, lowercaseAttrName=True):
+        sanitizer.HTMLSanitizer.__init__(self, stream, encoding, parseMeta,
+                                         useChardet,
+                                         lowercaseElementName,
+                                         lowercaseAttrName)
+
+class AnyCaseNoSrc(AnyCase):
+    allowed_attributes = AnyCase.allowed_attributes[:]
+    allowed_attributes.remove('src')
+
+def sanitize_html(stream, srcAttr=False):
+    with metrics.stage('sanitize_html'):
+        ret = ''.join([token.toxml() for token in
+                       html5parser.HTMLParser(tokenizer=AnyCase if srcAttr else AnyCaseNoSrc).
+                       parseFragment(stream).childNodes])
+    return ret
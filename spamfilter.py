@@ -0,0 +1,142 @@
+"""
+spam checks for new comments, cheapest first. SpamRules are the local
+ones from spamrules.conf; HttpBl asks projecthoneypot about the poster's
+ip, which costs a dns lookup, so it goes last.
+"""
+import os, re, time, logging
+from twisted.internet import defer
+import metrics
+
+log = logging.getLogger()
+
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "spamrules.conf")
+
+class SpamRejected(ValueError):
+    """rule is the name of the rule that fired"""
+    def __init__(self, msg, rule):
+        ValueError.__init__(self, msg)
+        self.rule = rule
+
+class SpamRules(object):
+    """
+    the rules in a file like spamrules.conf, one per line:
+
+      article <uri>        no comments on this post
+      substring <text>     content can't contain this (any case)
+      regex <pattern>      content can't match this (lowercased)
+
+    They all run over one lowercased copy of the content. Substrings
+    are plain 'in' tests and each regex is searched on its own: python's
+    re is slower with them all in one alternation, since that defeats
+    its scan for a literal prefix. The file is reloaded if it
+    changed, checking at most every checkInterval secs. A bad file
+    raises ValueError when we're made, but a bad edit later is only
+    logged, and the old rules stay until the next edit. With
+    path=None, the rules are only what you load().
+    """
+    def __init__(self, path=RULES_FILE, checkInterval=5, clock=time.time):
+        self.path = path
+        self.checkInterval = checkInterval
+        self.clock = clock
+        self.mtime = None
+        self.lastCheck = None
+        self.articles = set()
+        self.patterns = [] # (name, substring or compiled regex), in file order
+        self._reloadIfChanged()
+
+    def _reloadIfChanged(self):
+        if self.path is None:
+            return
+        now = self.clock()
+        if (self.lastCheck is not None and
+            now - self.lastCheck < self.checkInterval):
+            return
+        self.lastCheck = now
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return
+        first = self.mtime is None
+        self.mtime = mtime
+        try:
+            self.load(open(self.path).read().decode('utf8'))
+        except (ValueError, IOError), e:
+            if first:
+                raise
+            log.error("keeping the old spam rules: %s" % e)
+            return
+        log.info("loaded %s spam rules from %s" %
+                 (len(self.articles) + len(self.patterns), self.path))
+
+    def load(self, text):
+        articles, patterns = set(), []
+        for lineNum, line in enumerate(text.splitlines()):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            kind, _, arg = line.partition(' ')
+            arg = arg.strip()
+            if kind == 'article':
+                articles.add(arg)
+            elif kind == 'substring':
+                patterns.append((line, arg.lower()))
+            elif kind == 'regex':
+                try:
+                    patterns.append((line, re.compile(arg, re.UNICODE)))
+                except re.error, e:
+                    raise ValueError("%s line %s: bad regex %r: %s" %
+                                     (self.path, lineNum + 1, arg, e))
+            else:
+                raise ValueError("%s line %s: unknown rule %r" %
+                                 (self.path, lineNum + 1, kind))
+        self.articles = articles
+        self.patterns = patterns
+
+    def check(self, article, content, ip=None):
+        """raises SpamRejected for the first rule that fires"""
+        self._reloadIfChanged()
+        if unicode(article) in self.articles:
+            raise SpamRejected("comments are closed here",
+                               "article %s" % article)
+        lower = content.lower()
+        for name, pat in self.patterns:
+            if (pat in lower if isinstance(pat, unicode) else
+                pat.search(lower)):
+                raise SpamRejected("spam pattern", name)
+
+class HttpBl(object):
+    """a HoneypotChecker as a spam check"""
+    def __init__(self, honeypot):
+        self.honeypot = honeypot
+
+    def check(self, article, content, ip=None):
+        if ip is None:
+            return None
+        d = metrics.timedDeferred(self.honeypot.check(ip),
+                                  'stage_seconds', stage='httpbl')
+        def rejected(failure):
+            failure.trap(ValueError)
+            raise SpamRejected(failure.getErrorMessage(), "httpbl")
+        return d.addErrback(rejected)
+
+class SpamFilter(object):
+    """
+    runs checks in order; each has check(article, content, ip) that
+    returns None, raises SpamRejected, or returns a deferred that might
+    fail with it. Counts which rules fire.
+    """
+    def __init__(self, checks):
+        self.checks = checks
+        self.fired = {} # rule name : times
+
+    @defer.inlineCallbacks
+    def check(self, article, content, ip=None):
+        """deferred that fails with SpamRejected"""
+        for c in self.checks:
+            try:
+                yield c.check(article, content, ip)
+            except SpamRejected, e:
+                self.fired[e.rule] = self.fired.get(e.rule, 0) + 1
+                log.info("comment on %s from %s rejected by %r" %
+                         (article, ip, e.rule))
+                raise
@@ -0,0 +1,93 @@
+import unittest, tempfile, os
+from twisted.internet import defer
+from rdflib import URIRef
+from spamfilter import SpamRules, SpamFilter, SpamRejected, HttpBl
+
+RULES = u"""
+# comment
+article http://example.com/flooded
+substring <a href
+regex https?://\\S*\\s*$
+substring viagra
+"""
+
+class TestSpamRules(unittest.TestCase):
+    def setUp(self):
+        self.file = tempfile.NamedTemporaryFile(suffix=".conf")
+        self.file.write(RULES.encode('utf8'))
+        self.file.flush()
+        self.now = 1000
+        self.rules = SpamRules(self.file.name, checkInterval=10,
+                               clock=lambda: self.now)
+
+    def firedRule(self, content, article="http://example.com/post"):
+        try:
+            self.rules.check(URIRef(article), content)
+        except SpamRejected, e:
+            return e.rule
+        return None
+
+    def testReportsWhichRuleFired(self):
+        self.assertEqual(self.firedRule(u"buy VIAGRA now"), "substring viagra")
+        self.assertEqual(self.firedRule(u"see http://x.com"),
+                         r"regex https?://\S*\s*$")
+        self.assertEqual(self.firedRule(u"fine", "http://example.com/flooded"),
+                         "article http://example.com/flooded")
+        self.assertEqual(self.firedRule(u"a fine comment"), None)
+
+    def testFirstRuleInTheFileWins(self):
+        self.assertEqual(self.firedRule(u'viagra <a href="x">'),
+                         "substring <a href")
+
+    def testReloadsAfterInterval(self):
+        self.firedRule(u"x")
+        with open(self.file.name, "a") as f:
+            f.write("substring cialis\n")
+        os.utime(self.file.name, (0, 0))
+        self.assertEqual(self.firedRule(u"cialis"), None)
+        self.now += 10
+        self.assertEqual(self.firedRule(u"cialis"), "substring cialis")
+
+    def testBadEditKeepsTheOldRules(self):
+        with open(self.file.name, "a") as f:
+            f.write("regex (unclosed\n")
+        os.utime(self.file.name, (0, 0))
+        self.now += 10
+        self.assertEqual(self.firedRule(u"buy viagra"), "substring viagra")
+        self.assertEqual(self.firedRule(u"a fine comment"), None)
+        self.now += 10
+        self.assertEqual(self.firedRule(u"a fine comment"), None)
+
+    def testBadFileFailsAtStartup(self):
+        self.file.write("frobnicate x\n")
+        self.file.flush()
+        self.assertRaises(ValueError, SpamRules, self.file.name)
+
+class FakeHoneypot(object):
+    def __init__(self):
+        self.checked = []
+    def check(self, ip):
+        self.checked.append(ip)
+        return defer.fail(ValueError("IP %s rejected" % ip))
+
+class TestSpamFilter(unittest.TestCase):
+    def setUp(self):
+        rules = SpamRules(None)
+        rules.load(u"substring viagra")
+        self.honeypot = FakeHoneypot()
+        self.filter = SpamFilter([rules, HttpBl(self.honeypot)])
+
+    def fired(self, content):
+        ret = []
+        self.filter.check(URIRef("http://example.com/post"), content,
+                          "1.2.3.4").addErrback(
+            lambda f: ret.append(f.trap(SpamRejected) and f.value.rule))
+        return ret[0]
+
+    def testCheapRulesRunFirst(self):
+        self.assertEqual(self.fired(u"viagra"), "substring viagra")
+        self.assertEqual(self.honeypot.checked, [])
+
+    def testHoneypotRunsLast(self):
+        self.assertEqual(self.fired(u"hello"), "httpbl")
+        self.assertEqual(self.filter.fired, {"httpbl" : 1})
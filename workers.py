@@ -0,0 +1,122 @@
+"""
+running several server processes on one port. The parent opens the
+listening socket and starts workers (this same program, with
+--listen-fd) that adopt it, so the kernel hands each connection to one
+of them.
+
+Each worker keeps its own graph and caches. After a write, a worker
+tells the others over Peers, unix datagram sockets in a shared dir,
+and they catch up from the store right away. If a message is lost,
+new comments still show up at the worker's next --check-seconds poll.
+"""
+import os, sys, json, errno, socket, signal, time, logging, subprocess
+from twisted.internet.protocol import DatagramProtocol
+
+log = logging.getLogger()
+
+def listeningSocket(port, backlog=128):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+def runWorkers(n, port, peerDir, argv):
+    """
+    run n copies of argv (plus the worker options) sharing one socket
+    on port, restarting any that die, until we get SIGTERM or SIGINT
+    """
+    sock = listeningSocket(port)
+    if not os.path.isdir(peerDir):
+        os.makedirs(peerDir)
+
+    def start(i):
+        return subprocess.Popen(
+            [sys.executable] + argv +
+            ['--listen-fd', str(sock.fileno()), '--peer-dir', peerDir,
+             '--worker-index', str(i)])
+    procs = [start(i) for i in range(n)]
+
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        try:
+            pid, status = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        for i, p in enumerate(procs):
+            if p.pid == pid and not stopping:
+                log.warn("worker %s (pid %s) exited with %s; restarting" %
+                         (i, pid, status))
+                time.sleep(1) # don't spin if it dies at startup
+                procs[i] = start(i)
+    for p in procs:
+        p.wait()
+
+class Peers(DatagramProtocol):
+    """
+    news between the workers on one machine. Each has a socket in dir
+    named by its pid; send() writes to all the others.
+
+    Messages are json:
+      {"added" : parent}                      new comment on parent
+      {"setTypes" : [docId, ...], "type" : t}  comments' types changed
+    """
+    def __init__(self, dir, db):
+        self.dir = dir
+        self.db = db
+        self.path = os.path.join(dir, "%s.sock" % os.getpid())
+        self.received = self.sent = self.failed = 0
+
+    def listen(self, reactor):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        return reactor.listenUNIXDatagram(self.path, self)
+
+    def send(self, msg):
+        data = json.dumps(msg)
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
+            if path == self.path or not name.endswith(".sock"):
+                continue
+            try:
+                self.transport.write(data, path)
+                self.sent += 1
+            except socket.error, e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # a worker that's gone; its replacement has a new pid
+                    log.info("removing stale peer socket %s" % path)
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                else:
+                    self.failed += 1
+                    log.warn("couldn't tell peer %s: %s" % (path, e))
+
+    def commentAdded(self, parent):
+        self.send({'added' : parent})
+
+    def typesChanged(self, docIds, type):
+        self.send({'setTypes' : list(docIds), 'type' : type})
+
+    def datagramReceived(self, data, addr):
+        self.received += 1
+        msg = json.loads(data)
+        if 'added' in msg:
+            # comes back through onParentChanged, so caches get cleared
+            self.db.refresh()
+        elif 'setTypes' in msg:
+            d = self.db.typesChanged(msg['setTypes'], msg['type'])
+            d.addErrback(lambda f: log.error("catching up on types: %s" %
+                                             f.getTraceback()))
@@ -0,0 +1,54 @@
+import unittest, tempfile, shutil, os, json, errno, socket
+from twisted.internet import defer
+from workers import Peers
+
+class FakeDb(object):
+    def __init__(self):
+        self.calls = []
+    def refresh(self):
+        self.calls.append(('refresh',))
+        return defer.succeed(None)
+    def typesChanged(self, docIds, type):
+        self.calls.append(('typesChanged', docIds, type))
+        return defer.succeed(set())
+
+class FakeTransport(object):
+    def __init__(self, gone=()):
+        self.written = []
+        self.gone = gone
+    def write(self, data, path):
+        if os.path.basename(path) in self.gone:
+            raise socket.error(errno.ECONNREFUSED, "Connection refused")
+        self.written.append((path, json.loads(data)))
+
+class TestPeers(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = FakeDb()
+        self.peers = Peers(self.dir, self.db)
+        for name in [os.path.basename(self.peers.path), "1.sock", "2.sock"]:
+            open(os.path.join(self.dir, name), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testSendsToTheOthers(self):
+        self.peers.transport = FakeTransport()
+        self.peers.commentAdded("http://example.com/post")
+        self.assertEqual(sorted(os.path.basename(p)
+                                for p, msg in self.peers.transport.written),
+                         ["1.sock", "2.sock"])
+        self.assertEqual(self.peers.transport.written[0][1],
+                         {'added' : "http://example.com/post"})
+
+    def testRemovesSocketsOfGoneWorkers(self):
+        self.peers.transport = FakeTransport(gone=["2.sock"])
+        self.peers.typesChanged(["a", "b"], "spam")
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "2.sock")))
+        self.assertEqual(self.peers.sent, 1)
+
+    def testReceiving(self):
+        self.peers.datagramReceived(json.dumps({'added' : "http://example.com/post"}), None)
+        self.peers.datagramReceived(json.dumps({'setTypes' : ["a"], 'type' : "spam"}), None)
+        self.assertEqual(self.db.calls, [('refresh',),
+                                         ('typesChanged', ["a"], "spam")])